@@ -5,6 +5,61 @@
 
 import ConfigParser
 import shlex
+import os.path
+
+class LvmVolume(object):
+    """One logical volume to snapshot, mount and back up.
+
+    name: None for the main volume in [lvm], else the name of its
+          [lvm:name] section.
+    mount_at: Where the snapshot is mounted, relative to the root of the
+              backup.  The empty string for the main volume.
+    """
+    def __init__(self, name, vg, lv, snapshot_lv_name, snapshot_size, mount_at):
+        self.name = name
+        self.vg = vg
+        self.lv = lv
+        self.snapshot_lv_name = snapshot_lv_name
+        self.snapshot_size = snapshot_size
+        self.mount_at = mount_at.strip('/')
+
+    def source_device(self):
+        return os.path.join('/dev', self.vg, self.lv)
+
+    def snapshot_device(self):
+        return os.path.join('/dev', self.vg, self.snapshot_lv_name)
+
+    def snapshot_volpath(self):
+        return self.vg + '/' + self.snapshot_lv_name
+
+    def __repr__(self):
+        return 'LvmVolume(%r, %r/%r at %r)' % (self.name, self.vg, self.lv, self.mount_at)
+
+
+class QuiesceHook(object):
+    """The commands to quiesce and thaw one application around the
+    snapshots, from a [quiesce:name] section.
+
+    quiesce, thaw: Commands run to completion, or None.
+    hold: A command that keeps the application quiesced for as long as it
+          runs, or None.  It must print a line once the application is
+          quiesced, and exit when its standard input is closed.
+    timeout: Seconds allowed to quiesce.
+    thaw_timeout: Seconds allowed to thaw.
+    required: Whether the backup should fail if it can't be quiesced.
+    """
+    def __init__(self, name, quiesce, thaw, hold, timeout, thaw_timeout, required):
+        self.name = name
+        self.quiesce = quiesce
+        self.thaw = thaw
+        self.hold = hold
+        self.timeout = timeout
+        self.thaw_timeout = thaw_timeout
+        self.required = required
+
+    def __repr__(self):
+        return 'QuiesceHook(%r)' % self.name
+
 
 class BackupConf(object):
     """Backup configuration.
@@ -85,17 +140,221 @@ class BackupConf(object):
         """
         return self.conf.get('lvm', 'logical_volume')
 
+    def lvm_volumes(self):
+        """Return the list of LvmVolume to snapshot: the one in [lvm] first,
+        then any listed in [lvm] extra_volumes, in order.
+        """
+        volumes = [LvmVolume(None, self.lvm_vg(), self.lvm_lv(),
+                             self.lvm_snapshot_lv_name(), self.lvm_snapshot_size(), '')]
+        for name in self.lvm_extra_volume_names():
+            volumes.append(self._lvm_extra_volume(name))
+        return volumes
+
+    def lvm_extra_volume_names(self):
+        """Names of further logical volumes to snapshot along with the one
+        in [lvm], each described in its own [lvm:name] section.
+
+        Their snapshots are made one straight after the other, mounted at
+        their mount_at directories under the main volume's snapshot, and
+        archived at the same time, each to its own archive named after the
+        main one with .name on the end.
+
+        If not present, the empty list is returned.
+
+        [lvm]
+        extra_volumes = var home
+        """
+        if not self.conf.has_option('lvm', 'extra_volumes'):
+            return []
+        return shlex.split(self.conf.get('lvm', 'extra_volumes'))
+
+    def _lvm_extra_volume(self, name):
+        """Return the LvmVolume described by [lvm:name].
+
+        volume_group and snapshot_size default to those in [lvm].
+        snapshot_lv_name defaults to logical_volume with -backsnap appended.
+
+        [lvm:var]
+        logical_volume = os-var
+        mount_at = var
+        """
+        section = 'lvm:' + name
+        def get(option, default=None):
+            if default is not None and not self.conf.has_option(section, option):
+                return default
+            return self.conf.get(section, option)
+        lv = get('logical_volume')
+        return LvmVolume(
+                name,
+                get('volume_group', self.lvm_vg()),
+                lv,
+                get('snapshot_lv_name', lv + '-backsnap'),
+                get('snapshot_size', self.lvm_snapshot_size()),
+                get('mount_at'),
+        )
+
+    def lvm_fsfreeze(self):
+        """Whether to freeze all the source filesystems with fsfreeze while
+        their snapshots are made, so that they're consistent with each other.
+
+        If this config option is not present, it is assumed False.
+
+        [lvm]
+        fsfreeze = true
+        """
+        try:
+            return self.conf.getboolean('lvm', 'fsfreeze')
+        except ConfigParser.NoOptionError:
+            return False
+
+    def quiesce_hooks(self):
+        """Return a QuiesceHook for each [quiesce:name] section.
+
+        The hooks are all run at once, just before the snapshots are made,
+        and their applications thawed as soon as the snapshots exist.
+        Commands are parsed like a shell command, but not run in a shell.
+
+        Each hook needs quiesce, hold, or both.  thaw is optional.
+        timeout defaults to 10 seconds and thaw_timeout to 30.  If
+        required is false, a hook that fails only gives a warning; it
+        defaults to true, failing the backup.
+
+        [quiesce:postgres]
+        quiesce = su postgres -c "psql -c CHECKPOINT"
+
+        [quiesce:mysql]
+        hold = /usr/local/sbin/mysql-hold-read-lock
+        timeout = 5
+        required = false
+        """
+        hooks = []
+        for section in self.conf.sections():
+            if not section.startswith('quiesce:'):
+                continue
+            def get(option, default=None):
+                if not self.conf.has_option(section, option):
+                    return default
+                return self.conf.get(section, option)
+            if get('quiesce') is None and get('hold') is None:
+                raise ValueError('[%s] needs quiesce or hold' % section)
+            required = True
+            if self.conf.has_option(section, 'required'):
+                required = self.conf.getboolean(section, 'required')
+            hooks.append(QuiesceHook(
+                    section.partition(':')[2],
+                    get('quiesce'),
+                    get('thaw'),
+                    get('hold'),
+                    float(get('timeout', 10)),
+                    float(get('thaw_timeout', 30)),
+                    required,
+            ))
+        return hooks
+
     def backup_target(self):
         """The path to the base directory for backups taken with this configuration.
 
         Backups are placed in per-month directories underneath the directory
-        specified here.
+        specified here, or per-set directories if [rollover] is configured.
 
         [backup]
         target = /net/someserver/backups/somedir
         """
         return self.conf.get('backup', 'target')
 
+    def rollover_configured(self):
+        """Returns True if there's a [rollover] section, meaning backup sets
+        are started according to its limits rather than once a month.
+        """
+        return self.conf.has_section('rollover')
+
+    def _rollover_number(self, option, convert):
+        """Return the option in [rollover] converted with convert(), or None
+        if it isn't present.
+        """
+        if not self.conf.has_option('rollover', option):
+            return None
+        return convert(self.conf.get('rollover', option))
+
+    def rollover_max_incremental_percent(self):
+        """Start a new set when the incrementals in the current one add up
+        to at least this percentage of the size of its full backup.
+
+        None if not present.
+
+        [rollover]
+        max_incremental_percent = 50
+        """
+        return self._rollover_number('max_incremental_percent', float)
+
+    def rollover_max_chain_length(self):
+        """Start a new set when the current one has this many incrementals.
+
+        None if not present.
+
+        [rollover]
+        max_chain_length = 30
+        """
+        return self._rollover_number('max_chain_length', int)
+
+    def rollover_max_age_days(self):
+        """Start a new set when its full backup is at least this many days old.
+
+        None if not present.
+
+        [rollover]
+        max_age_days = 60
+        """
+        return self._rollover_number('max_age_days', int)
+
+    def rollover_spread_days(self):
+        """Schedule a full backup every this many days, on days offset by
+        a hash of [backup] archive_prefix so profiles don't all do their
+        fulls on the same day.
+
+        None if not present.
+
+        [rollover]
+        spread_days = 28
+        """
+        return self._rollover_number('spread_days', int)
+
+    def backup_strategy(self):
+        """How to store backups.  Either:
+         dar - full and incremental dar archives (the default)
+         hardlink - a browsable directory tree per backup, made with
+                    rsync --link-dest so unchanged files are hard links
+                    to the previous tree.
+
+        hardlink can't be used with [s3], as object stores have no hard
+        links, so every tree would be uploaded in full.
+
+        [backup]
+        strategy = hardlink
+        """
+        if not self.conf.has_option('backup', 'strategy'):
+            return 'dar'
+        strategy = self.conf.get('backup', 'strategy')
+        if strategy not in ('dar', 'hardlink'):
+            raise ValueError('Unknown backup strategy: %s' % strategy)
+        if strategy == 'hardlink' and self.s3_enabled():
+            raise ValueError('strategy = hardlink can\'t be used with [s3] enabled')
+        return strategy
+
+    def backup_compression_level(self):
+        """The gzip compression level dar uses, from 0 (no compression) to
+        9 (the default).
+
+        [backup]
+        compression_level = 6
+        """
+        if not self.conf.has_option('backup', 'compression_level'):
+            return 9
+        level = self.conf.getint('backup', 'compression_level')
+        if not 0 <= level <= 9:
+            raise ValueError('compression_level must be from 0 to 9, not %d' % level)
+        return level
+
     def backup_archive_prefix(self):
         """The start of the name to give each archive file.
 
@@ -132,6 +391,88 @@ class BackupConf(object):
         except ConfigParser.NoOptionError:
             return []
 
+    def skip_unchanged(self):
+        """Whether to skip the snapshot and backup when the source logical
+        volume hasn't been written to since the last successful backup.
+
+        The kernel's write counters for the volume are recorded at each
+        successful backup.  If they're the same next time, an unchanged
+        restore point is recorded in backup_deps instead of running dar.
+
+        This is never done for full backups, or when [bindmounts] are
+        configured, because writes to bind-mounted directories aren't counted.
+
+        If this config option is not present, it is assumed False.
+
+        [backup]
+        skip_unchanged = true
+        """
+        try:
+            return self.conf.getboolean('backup', 'skip_unchanged')
+        except ConfigParser.NoOptionError:
+            return False
+
+    def _exclude_list(self, option):
+        """Return the shlex-split value of an option in [exclude], or the
+        empty list if it or the section isn't present.
+        """
+        if not self.conf.has_option('exclude', option):
+            return []
+        return shlex.split(self.conf.get('exclude', option))
+
+    def exclude_paths(self):
+        """Paths to leave out of the backup, relative to the root of the
+        backup.  They may contain shell-style wildcards, which match across
+        slashes too.  Excluded directories are stored empty.
+
+        Parsed like a shell command, as with [backup] subdirs.
+
+        [exclude]
+        paths = var/tmp home/*/Downloads
+        """
+        return self._exclude_list('paths')
+
+    def exclude_names(self):
+        """Filename patterns to leave out wherever they are in the tree.
+        They only match files, not directories; to leave out directories
+        of a given name, put */name in paths.
+
+        [exclude]
+        names = *.o *.pyc
+        """
+        return self._exclude_list('names')
+
+    def exclude_regexes(self):
+        """Regular expressions matched against the path relative to the
+        root of the backup.  Anything matching is left out.
+
+        [exclude]
+        regexes = '^home/[^/]+/\\.local/share/Steam/'
+        """
+        return self._exclude_list('regexes')
+
+    def exclude_cachedir_tag(self):
+        """Whether to leave out the contents of directories containing a
+        CACHEDIR.TAG file (see http://www.brynosaurus.com/cachedir/).
+
+        If this config option or [exclude] is not present, it is assumed False.
+
+        [exclude]
+        cachedir_tag = true
+        """
+        if not self.conf.has_option('exclude', 'cachedir_tag'):
+            return False
+        return self.conf.getboolean('exclude', 'cachedir_tag')
+
+    def exclude_profiles(self):
+        """Names of built-in sets of regenerable paths to leave out,
+        as listed in exclusions.PROFILES.  Currently: common
+
+        [exclude]
+        profiles = common
+        """
+        return self._exclude_list('profiles')
+
     def bindmounts_equals(self):
         """Return the subdirectories that should be bind-mounted to the current root filesystem.
 
@@ -187,6 +528,307 @@ class BackupConf(object):
             path += '/'
         return path
 
+    def s3_enabled(self):
+        """Whether or not to upload the backup sets to an S3-compatible
+        object store after the backup.
+
+        If this config option or [s3] is not present, it is assumed False.
+
+        [s3]
+        enabled = true
+        """
+        try:
+            return self.conf.getboolean('s3', 'enabled')
+        except ConfigParser.NoOptionError:
+            return False
+        except ConfigParser.NoSectionError:
+            return False
+
+    def _s3_optional(self, option, default=None):
+        """Return the option in [s3], or default if it isn't present."""
+        if not self.conf.has_option('s3', option):
+            return default
+        return self.conf.get('s3', option)
+
+    def s3_bucket(self):
+        """The bucket to upload to.
+
+        [s3]
+        bucket = backups
+        """
+        return self.conf.get('s3', 'bucket')
+
+    def s3_prefix(self):
+        """The start of the key of every object uploaded.  Each backup set
+        is uploaded under it as it's laid out under [backup] target.
+
+        Defaults to the empty string.
+
+        [s3]
+        prefix = hostname/os-xub-precise
+        """
+        return self._s3_optional('prefix', '')
+
+    def s3_endpoint_url(self):
+        """The URL of the S3-compatible service, for anything other than
+        Amazon S3 itself, e.g. a local MinIO server.
+
+        None (meaning Amazon S3) if not present.
+
+        [s3]
+        endpoint_url = http://localhost:9000
+        """
+        return self._s3_optional('endpoint_url')
+
+    def s3_region(self):
+        """The region of the bucket, or None if not present.
+
+        [s3]
+        region = eu-west-1
+        """
+        return self._s3_optional('region')
+
+    def s3_access_key_id(self):
+        """The access key id to use.  If not present, None is returned and
+        the usual boto3 places (environment, ~/.aws) are looked in instead.
+
+        [s3]
+        access_key_id = AKIA...
+        """
+        return self._s3_optional('access_key_id')
+
+    def s3_secret_access_key(self):
+        """The secret access key to go with access_key_id, or None.
+
+        [s3]
+        secret_access_key = ...
+        """
+        return self._s3_optional('secret_access_key')
+
+    def s3_part_size_mb(self):
+        """The size of each part of a multipart upload, in megabytes.
+
+        Slices no bigger than this are uploaded in one go.  S3 needs parts
+        of at least 5MB.  Defaults to 64.
+
+        [s3]
+        part_size_mb = 64
+        """
+        return max(5, int(self._s3_optional('part_size_mb', 64)))
+
+    def s3_concurrency(self):
+        """How many parts to upload at once.  This many parts are held in
+        memory at most.  Defaults to 4.
+
+        [s3]
+        concurrency = 4
+        """
+        return int(self._s3_optional('concurrency', 4))
+
+    def prefetch_enabled(self):
+        """Whether to read the files being backed up into the page cache
+        in physical block order, a little ahead of dar.  Helps most on
+        spinning disks, where dar's directory-order reads are seek-bound.
+
+        If this config option or [prefetch] is not present, it is assumed False.
+
+        [prefetch]
+        enabled = true
+        """
+        try:
+            return self.conf.getboolean('prefetch', 'enabled')
+        except ConfigParser.NoOptionError:
+            return False
+        except ConfigParser.NoSectionError:
+            return False
+
+    def prefetch_window_mb(self):
+        """How far ahead of the backup's reads to prefetch, in megabytes.
+        Defaults to 512.
+
+        [prefetch]
+        window_mb = 512
+        """
+        if not self.conf.has_option('prefetch', 'window_mb'):
+            return 512
+        return int(self.conf.get('prefetch', 'window_mb'))
+
+    def prefetch_min_available_mb(self):
+        """Pause prefetching while MemAvailable is below this many
+        megabytes.  Defaults to 1024.
+
+        [prefetch]
+        min_available_mb = 1024
+        """
+        if not self.conf.has_option('prefetch', 'min_available_mb'):
+            return 1024
+        return int(self.conf.get('prefetch', 'min_available_mb'))
+
+    def checkpoint_enabled(self):
+        """Whether to make each dar backup in work units, checkpointed in a
+        journal in the backup set, so that if it fails, the next backup
+        (within resume_hours) only makes the units that weren't finished.
+
+        The units are decided at each full backup, by sharing out the
+        entries at the top of each volume into size-balanced groups.
+
+        If this config option or [checkpoint] is not present, it is assumed False.
+
+        [checkpoint]
+        enabled = true
+        """
+        try:
+            return self.conf.getboolean('checkpoint', 'enabled')
+        except ConfigParser.NoOptionError:
+            return False
+        except ConfigParser.NoSectionError:
+            return False
+
+    def checkpoint_units(self):
+        """How many work units to split each volume into, not counting the
+        one for everything else.  Defaults to 8.
+
+        [checkpoint]
+        units = 8
+        """
+        if not self.conf.has_option('checkpoint', 'units'):
+            return 8
+        return max(1, int(self.conf.get('checkpoint', 'units')))
+
+    def checkpoint_resume_hours(self):
+        """How long after an unfinished backup was started it can still be
+        resumed, in hours.  After that, it's thrown away and a new backup
+        started.  Defaults to 12.
+
+        [checkpoint]
+        resume_hours = 12
+        """
+        if not self.conf.has_option('checkpoint', 'resume_hours'):
+            return 12.0
+        return float(self.conf.get('checkpoint', 'resume_hours'))
+
+    def synthesize_overwrite_policy(self):
+        """The dar overwriting policy (-/) used by the synthesize script
+        when merging an archive with a newer one.  The older archive is
+        'in place' and the newer 'to be added'.
+
+        The default keeps the newer entry when it has its data saved in
+        the newer archive (~S tests the entry to be added), and the older
+        entry when it's only recorded there as unchanged.  Files deleted
+        since the full backup are left out whatever the policy.
+
+        [synthesize]
+        overwrite_policy = {~S}[Oo][Pp]
+        """
+        if not self.conf.has_option('synthesize', 'overwrite_policy'):
+            return '{~S}[Oo][Pp]'
+        return self.conf.get('synthesize', 'overwrite_policy')
+
+    def _schedule_optional(self, option, default=None):
+        """Return the option in [schedule], or default if it isn't present."""
+        if not self.conf.has_option('schedule', option):
+            return default
+        return self.conf.get('schedule', option)
+
+    def schedule_interval_hours(self):
+        """How often the scheduler (backup --scheduler) backs up this
+        profile, in hours.  Defaults to 24.
+
+        [schedule]
+        interval_hours = 24
+        """
+        return float(self._schedule_optional('interval_hours', 24))
+
+    def schedule_start_at(self):
+        """The time of day in UTC, as (hour, minute), the scheduler's
+        intervals are counted from.  It's UTC so the intervals stay the
+        same length when the clocks change.  Defaults to midnight.
+
+        [schedule]
+        start_at = 01:30
+        """
+        hour, _, minute = self._schedule_optional('start_at', '00:00').partition(':')
+        return int(hour), int(minute or 0)
+
+    def schedule_jitter_minutes(self):
+        """Up to how many minutes after each scheduled time to start.
+
+        The delay is worked out from a hash of the host name and
+        [backup] archive_prefix, so it's the same every time for a profile
+        but different hosts start at different times.  Defaults to 60.
+
+        [schedule]
+        jitter_minutes = 60
+        """
+        return int(self._schedule_optional('jitter_minutes', 60))
+
+    def schedule_retry_minutes(self):
+        """How long the scheduler waits before trying again after a
+        failed backup.  Defaults to 60.
+
+        [schedule]
+        retry_minutes = 60
+        """
+        return int(self._schedule_optional('retry_minutes', 60))
+
+    def schedule_max_load(self):
+        """Don't start while the 1-minute load average is above this.
+        Defaults to the number of CPUs.
+
+        [schedule]
+        max_load = 4
+        """
+        value = self._schedule_optional('max_load')
+        if value is None:
+            return None
+        return float(value)
+
+    def schedule_max_pressure(self):
+        """Don't start while the CPU or IO pressure (the 'some avg10'
+        percentage in /proc/pressure) is above this.  Ignored on kernels
+        without pressure stall information.  Defaults to 20.
+
+        [schedule]
+        max_pressure = 20
+        """
+        return float(self._schedule_optional('max_pressure', 20))
+
+    def schedule_max_delay_minutes(self):
+        """Start anyway, however busy the host is, once a backup has been
+        held back this many minutes past its due time.  Defaults to 240.
+
+        [schedule]
+        max_delay_minutes = 240
+        """
+        return int(self._schedule_optional('max_delay_minutes', 240))
+
+    def schedule_target_slots(self):
+        """How many backups may run against the slots_dir at once, across
+        every host and profile using it.  Defaults to 1.
+
+        [schedule]
+        target_slots = 2
+        """
+        return max(1, int(self._schedule_optional('target_slots', 1)))
+
+    def schedule_slots_dir(self):
+        """The directory holding the slot files that limit how many backups
+        run against a target at once.  Point every profile sharing a
+        server at the same directory on it.
+
+        Defaults to the directory above [rsync] target_dir if rsync is
+        enabled, else the directory above [backup] target.
+
+        [schedule]
+        slots_dir = /net/windle/backups
+        """
+        value = self._schedule_optional('slots_dir')
+        if value:
+            return value
+        if self.rsync_enabled():
+            return os.path.dirname(self.rsync_target_dir().rstrip('/'))
+        return os.path.dirname(self.backup_target().rstrip('/'))
+
     def rsync_even_if_backup_failed(self):
         """Specify whether the rsync should still happen even if the backup itself failed.
 
@@ -0,0 +1,187 @@
+#! /usr/bin/env python
+
+"""Read the backup dependency records of every backup set.
+"""
+
+import os
+import os.path
+import errno
+import datetime
+import re
+
+DEPS_FILENAME = 'backup_deps'
+
+# Suffix of restore points recorded when the source hadn't been written to
+# since the previous backup.  No archive is made for them.
+UNCHANGED_SUFFIX = '-UNCHANGED'
+
+# Suffix of backups that are browsable directory trees made by the hardlink
+# strategy rather than dar archives.
+TREE_SUFFIX = '-TREE'
+
+def part_name(archive, part):
+    """The name of the archive holding one part of a backup, such as one of
+    several volumes.  The part named None is the archive itself.
+    """
+    if part is None:
+        return archive
+    return '%s.%s' % (archive, part)
+
+def archive_time(archive, archive_prefix):
+    """Return the datetime an archive was started, from its name, or None
+    if the name isn't in the usual form of prefix, timestamp and suffix.
+    """
+    if not archive.startswith(archive_prefix):
+        return None
+    stamp = archive[len(archive_prefix):][:len('YYYY-MM-DDTHHMM')]
+    try:
+        return datetime.datetime.strptime(stamp, '%Y-%m-%dT%H%M')
+    except ValueError:
+        return None
+
+def archive_bytes(set_root, archive):
+    """Return the total size of the slices of an archive in a backup set,
+    including those of any parts of it.
+    """
+    pattern = re.compile(r'^%s(\..+)?\.\d+\.dar$' % re.escape(archive))
+    total = 0
+    for filename in os.listdir(set_root):
+        if pattern.match(filename):
+            total += os.path.getsize(os.path.join(set_root, filename))
+    return total
+
+
+class DepsEntry(object):
+    """One line of a backup_deps file.
+
+    set_name: The basename of the backup set directory the entry was found in.
+    archive: The name of the archive (dar basename, without slice suffixes).
+    parent: The name of the parent archive, or None for a full backup.
+    """
+    def __init__(self, set_name, archive, parent):
+        self.set_name = set_name
+        self.archive = archive
+        self.parent = parent or None
+
+    def has_archive(self):
+        """Return False if this is an unchanged restore point with no archive
+        of its own, in which case its data is all in the parent.
+        """
+        return not self.archive.endswith(UNCHANGED_SUFFIX)
+
+    def is_tree(self):
+        """Return True if this backup is a complete directory tree rather
+        than a dar archive.
+        """
+        return self.archive.endswith(TREE_SUFFIX)
+
+    def __repr__(self):
+        return 'DepsEntry(%r, %r, %r)' % (self.set_name, self.archive, self.parent)
+
+
+class BackupDeps(object):
+    """The combined dependency records of all backup sets under a backup root.
+
+    This only ever reads from the backup root, so it's safe to point it at
+    a mirror such as the [rsync] target_dir.
+    """
+    def __init__(self, backup_root, archive_prefix):
+        """
+        backup_root: The directory containing one directory per backup set.
+        archive_prefix: The configured [backup] archive_prefix.
+        """
+        self.backup_root = backup_root
+        self.archive_prefix = archive_prefix
+        self._entries = None
+
+    def set_names(self):
+        """Return the names of the backup sets under the backup root that
+        have a backup_deps file.
+        """
+        names = []
+        for name in sorted(os.listdir(self.backup_root)):
+            if os.path.isfile(self.deps_filename(name)):
+                names.append(name)
+        return names
+
+    def set_root(self, set_name):
+        """The full path to the directory of the given backup set."""
+        return os.path.join(self.backup_root, set_name)
+
+    def deps_filename(self, set_name):
+        """The full path to the backup_deps file of the given backup set."""
+        return os.path.join(self.set_root(set_name), DEPS_FILENAME)
+
+    def entries(self):
+        """Return a DepsEntry for every backup recorded under the backup root,
+        newest first.
+
+        The archive names all start with the archive prefix followed by
+        an ISO-8601-like timestamp, so sorting on what follows the prefix
+        orders them by time, regardless of how the set directories are named.
+        """
+        if self._entries is None:
+            entries = []
+            for set_name in self.set_names():
+                entries.extend(self._read_set(set_name))
+            entries.sort(key=self._sort_key, reverse=True)
+            self._entries = entries
+        return self._entries
+
+    def _sort_key(self, entry):
+        if entry.archive.startswith(self.archive_prefix):
+            return entry.archive[len(self.archive_prefix):]
+        return entry.archive
+
+    def _read_set(self, set_name):
+        """Return the DepsEntry list for a single backup set, in file order.
+        """
+        try:
+            depf = open(self.deps_filename(set_name))
+        except IOError, exc:
+            if exc.errno == errno.ENOENT:
+                return []
+            raise
+        entries = []
+        try:
+            for line in depf:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                archive, _, parent = line.partition(':')
+                entries.append(DepsEntry(set_name, archive, parent))
+        finally:
+            depf.close()
+        return entries
+
+    def find(self, archive):
+        """Return the DepsEntry for the named archive, or None if not recorded.
+        """
+        for entry in self.entries():
+            if entry.archive == archive:
+                return entry
+        return None
+
+    def newest(self):
+        """Return the DepsEntry of the newest backup, or None if there are none.
+        """
+        entries = self.entries()
+        if not entries:
+            return None
+        return entries[0]
+
+    def chain(self, archive):
+        """Return the list of DepsEntry from the named archive back to its
+        full backup, newest first.
+
+        KeyError is raised if the archive or one of its ancestors isn't
+        recorded in any backup_deps file.
+        """
+        chain = []
+        while archive:
+            entry = self.find(archive)
+            if entry is None:
+                raise KeyError(archive)
+            chain.append(entry)
+            archive = entry.parent
+        return chain
@@ -4,11 +4,29 @@
 """
 import datetime
 import program_runners
+import backup_deps
+import write_counters
+import exclusions
+import rollover_policy
+import run_history
+import checkpoint
+import estimator
+import os
 import os.path
 import logging
 import errno
+import re
+import shutil
+import time
+import threading
 from arglist import ArgList
 
+# Split into < 2GB slices so they can go on ISO9660 DVDs
+SLICE_SIZE = 1875000000
+
+# Added to the name of a hard-link tree while it's being made
+PARTIAL_SUFFIX = '.partial'
+
 class BackupCopy(object):
     """This encapsulates the copy operation for the backup.
 
@@ -31,6 +49,7 @@ class BackupCopy(object):
         self._backup_source_root_override = backup_source_root
         self._setup_logging()
         self.backup_date = datetime.datetime.now()
+        self.rollover = rollover_policy.for_config(config)
         self._make_backup_set()
 
     def _setup_logging(self):
@@ -54,12 +73,15 @@ class BackupCopy(object):
     def run(self):
         """Select and run a backup strategy (full or incremental)
         """
-        backup_strategy = self._get_backup_strategy()
-        backup_strategy.run()
+        self._start_journal()
+        self.strategy = self._get_backup_strategy()
+        self.strategy.run()
 
     def _get_backup_strategy(self):
         """Return the appropriate backup strategy for this backup operation.
         """
+        if self.conf.backup_strategy() == 'hardlink':
+            return HardlinkBackupStrategy(self)
         if self.is_full_backup():
             return FullBackupStrategy(self)
         else:
@@ -74,28 +96,110 @@ class BackupCopy(object):
         """
         return self.conf.backup_archive_prefix()
 
+    def compression_level(self):
+        """The configured gzip compression level for dar, 0 for none."""
+        return self.conf.backup_compression_level()
+
+    def backup_kind(self):
+        """'full' or 'incremental', as recorded in the run history."""
+        if self.is_full_backup():
+            return 'full'
+        return 'incremental'
+
+    def changed_since(self):
+        """Return the time (in seconds since the epoch) after which changes
+        will go into this backup, or None if everything will.
+
+        That's when the parent backup was started, as taken from its name.
+        It's only to the minute, so errs on the side of counting too much.
+        """
+        parent = self.last_successful_backup_in_set()
+        if parent is None:
+            return None
+        started = backup_deps.archive_time(parent, self.backup_prefix())
+        if started is None:
+            return None
+        return time.mktime(started.timetuple())
+
+    def run_history(self):
+        """The RunHistory kept in the backup root."""
+        return run_history.RunHistory(self.backup_root())
+
+    def record_run(self, started, status):
+        """Append this run to the run history.
+
+        started: The datetime the backup itself started.
+        status: 'ok', 'failed' or 'unchanged'.
+
+        The changed bytes recorded are those dar (or rsync) read from the
+        source, which are the files changed since the parent, rather than
+        walking the source for them again.
+        """
+        archive = ''
+        archive_bytes = 0
+        changed_bytes = 0
+        if hasattr(self, 'strategy'):
+            changed_bytes = self.strategy.bytes_read()
+            if status == 'ok':
+                archive = self.strategy.get_archive_name()
+                if not self._noop():
+                    archive_bytes = backup_deps.archive_bytes(self.backup_set_root(), archive)
+        record = run_history.RunRecord(
+                started=started,
+                finished=datetime.datetime.now(),
+                status=status,
+                kind=self.backup_kind(),
+                archive=archive,
+                changed_bytes=changed_bytes,
+                archive_bytes=archive_bytes,
+        )
+        self.log.debug('Recording run %r', record.as_row())
+        if not self._noop():
+            self.run_history().append(record)
+
     def is_full_backup(self):
         """Return True if this will be a full backup, else False.
+
+        The rollover policy decides when to start a new backup set, which
+        has no successful backups yet, so always starts with a full.
         """
         return self.last_successful_backup_in_set() is None
 
     def backup_root(self):
         """The base directory for all backup sets for the current configuration.
 
-        Typically, a directory for each month is created underneath this
-        directory, and backup files are put inside there.
+        Typically, a directory for each month (or each set started by the
+        rollover policy) is created underneath this directory, and backup
+        files are put inside there.
         """
         return self.conf.backup_target()
 
     def backup_set_root(self):
-        """The full path to the directory containing this month's backup set.
+        """The full path to the directory containing the current backup set.
         """
         return os.path.join(self.backup_root(), self.backup_set_name())
 
     def backup_set_name(self):
-        """The basename of the directory containing this month's backup set.
+        """The basename of the directory containing the current backup set.
+
+        This is decided on first call, and remembered thereafter.
+        """
+        if not hasattr(self, '_set_name_memo'):
+            self._set_name_memo = self._choose_backup_set()
+        return self._set_name_memo
+
+    def _choose_backup_set(self):
+        """Ask the rollover policy whether to carry on with the current
+        backup set or start a new one, and return the name of the one to use.
         """
-        return self.backup_date.strftime('%Y-%m')
+        current = self.rollover.current_set_name(self.backup_date)
+        if current is not None:
+            reason = self.rollover.rollover_reason(
+                    os.path.join(self.backup_root(), current), self.backup_date)
+            if reason is None:
+                return current
+            self.log.info('Starting a new backup set: %s', reason)
+        return self.rollover.new_set_name(self.backup_date)
 
     def last_successful_filename(self):
         """The full path to the file that will contain the name of the last
@@ -107,7 +211,45 @@ class BackupCopy(object):
         """The full path to the file that documents the parent-child
         relationship between backups in the current set.
         """
-        return os.path.join(self.backup_set_root(), 'backup_deps')
+        return os.path.join(self.backup_set_root(), backup_deps.DEPS_FILENAME)
+
+    def write_counters_filename(self):
+        """The full path to the file that records the source volume's write
+        counters as of the last successful backup in the current set.
+        """
+        return os.path.join(self.backup_set_root(), 'write_counters')
+
+    def last_write_counters(self):
+        """Return the WriteCounters saved by the last successful backup in
+        the current set, or None if there aren't any.
+        """
+        return write_counters.WriteCounters.load(self.write_counters_filename())
+
+    def set_write_counters(self, counters):
+        """Save the source volume's write counters for the backup that's
+        just succeeded.
+        """
+        filename = self.write_counters_filename()
+        self.log.debug('Saving write counters %r to %r', counters, filename)
+        if not self._noop():
+            counters.save(filename)
+
+    def record_unchanged_backup(self):
+        """Record a restore point for a source that hasn't changed since
+        the last successful backup, without making an archive.
+
+        It's logged in the dependencies file with the last successful backup
+        as its parent, but isn't made the latest successful backup, so the
+        next incremental is still taken against a real archive.
+        """
+        parent = self.last_successful_backup_in_set()
+        name = self.archive_basename(backup_deps.UNCHANGED_SUFFIX)
+        print('Unchanged since: %s' % parent)
+        depf_name = self.deps_filename()
+        self.log.debug('Logging unchanged restore point to %r...', depf_name)
+        if not self._noop():
+            with open(depf_name, 'a') as depf:
+                depf.write("%s:%s\n" % (name, parent))
 
     def last_successful_backup_in_set(self):
         """Return name of last successful backup in set.
@@ -130,6 +272,9 @@ class BackupCopy(object):
         except IOError, exc:
             if exc.errno == errno.ENOENT:
                 self.log.debug("Last Successful file %r not found", self.last_successful_filename())
+                # Remembered too, so a full is still a full once it's
+                # been recorded as the latest successful backup.
+                self._parent_memo = None
                 return None
             else:
                 raise
@@ -179,6 +324,9 @@ class BackupCopy(object):
     def pre_backup(self):
         """Might eventually run a configurable pre-backup script.
         Currently just warns at INFO level that it's not implemented.
+
+        Applications are quiesced around the snapshots, by the
+        [quiesce:name] hooks, rather than here.
         """
         self.log.info('pre_backup() not implemented in this script')
 
@@ -205,6 +353,240 @@ class BackupCopy(object):
         """
         return self.conf.backup_subdirs()
 
+    def get_parts(self):
+        """Return the list of BackupPart to archive, one for each volume
+        being backed up, main volume first.
+
+        Parts with nothing to back up, because none of the chosen
+        subdirectories are on their volume, are left out.
+        """
+        if self.conf.source_is_lvm():
+            volumes = [(volume.name, volume.mount_at) for volume in self.conf.lvm_volumes()]
+        else:
+            volumes = [(None, '')]
+        parts = []
+        for name, mount_at in volumes:
+            subdirs = self._part_subdirs(mount_at)
+            if subdirs is None:
+                self.log.info('No chosen subdirectories on volume %r', name)
+                continue
+            nested = [other for (_, other) in volumes
+                      if other != mount_at and _is_under(other, mount_at)]
+            parts.append(BackupPart(name, subdirs, nested))
+        return parts
+
+    def _part_subdirs(self, mount_at):
+        """Return the -g subdirectories for the part mounted at mount_at,
+        the empty list for no restriction, or None if none of the chosen
+        subdirectories are on it.
+        """
+        chosen = [subdir.strip('/') for subdir in self.get_chosen_subdirs()]
+        if not mount_at:
+            return chosen
+        if not chosen:
+            return [mount_at]
+        subdirs = []
+        for subdir in chosen:
+            if _is_under(mount_at, subdir):
+                return [mount_at]
+            if _is_under(subdir, mount_at):
+                subdirs.append(subdir)
+        return subdirs or None
+
+    def checkpointing(self):
+        """Whether the backup is made in work units, checkpointed in a
+        journal so a failed backup can be resumed.
+        """
+        return self.conf.checkpoint_enabled() and self.conf.backup_strategy() == 'dar'
+
+    def _start_journal(self):
+        """Resume the unfinished backup in the journal, if there is one
+        that can be resumed, else start a new journal.
+
+        A backup can be resumed if it has the same parent as this one
+        would, and was started no more than [checkpoint] resume_hours ago.
+        It's resumed by taking its date, so its archive names, and only
+        archiving the units it hadn't finished.  Unfinished backups in
+        other sets, as left by a failure before a rollover, can't be, so
+        they're discarded.
+
+        Only done once, when first called.
+        """
+        if hasattr(self, 'journal'):
+            return
+        self.journal = None
+        if not self.checkpointing():
+            return
+        self._discard_other_journals()
+        parent = self.last_successful_backup_in_set() or ''
+        journal = checkpoint.Journal.load(self.backup_set_root())
+        if journal is not None:
+            if journal.can_resume(parent, datetime.datetime.now(),
+                                  self.conf.checkpoint_resume_hours()):
+                self.log.warn('Resuming the backup started %s, with %d unit(s) done',
+                              journal.started, len(journal.done))
+                self.backup_date = journal.backup_date
+                self.journal = journal
+                return
+            self.log.info('Not resuming the unfinished backup started %s', journal.started)
+            self._discard_journal(journal, self.backup_set_name())
+        self.journal = checkpoint.Journal(self.backup_set_root(), self.backup_date, parent)
+        if not self._noop():
+            self.journal.save()
+
+    def _discard_other_journals(self):
+        """Discard the unfinished backups in every set but the current one.
+        """
+        root = self.backup_root()
+        for set_name in sorted(os.listdir(root)):
+            if set_name == self.backup_set_name():
+                continue
+            set_root = os.path.join(root, set_name)
+            if not os.path.isfile(os.path.join(set_root, checkpoint.JOURNAL_FILENAME)):
+                continue
+            journal = checkpoint.Journal.load(set_root)
+            self.log.info('Discarding the unfinished backup started %s in %r',
+                          journal.started, set_name)
+            self._discard_journal(journal, set_name)
+
+    def _discard_journal(self, journal, set_name):
+        """Remove an unfinished backup's journal and the archives of the
+        units it made in the given set.
+        """
+        if self._noop():
+            return
+        set_root = os.path.join(self.backup_root(), set_name)
+        stem = self.backup_prefix() + journal.backup_date.strftime('%Y-%m-%dT%H%M')
+        pattern = re.compile(r'^(%s-(?:FULL|INC))\..+\.dar$' % re.escape(stem))
+        recorded = set(entry.archive for entry in
+                       backup_deps.BackupDeps(self.backup_root(), self.backup_prefix()).entries()
+                       if entry.set_name == set_name)
+        for filename in os.listdir(set_root):
+            match = pattern.match(filename)
+            if match and match.group(1) not in recorded:
+                self.log.debug('Removing %r', filename)
+                os.remove(os.path.join(set_root, filename))
+        journal.remove()
+
+    def unit_done(self, key):
+        """Record in the journal that the named unit's archive is complete.
+        """
+        if self.journal is not None and not self._noop():
+            self.journal.set_done(key)
+
+    def is_unit_done(self, key):
+        """Whether a resumed backup has already made the named unit's archive.
+        """
+        return self.journal is not None and self.journal.is_done(key)
+
+    def finish_journal(self):
+        """Remove the journal, once the backup has been recorded."""
+        if self.journal is not None and not self._noop():
+            self.journal.remove()
+
+    def done_unit_paths(self):
+        """Return the paths, relative to the source root, in the work units
+        that the unfinished backup being resumed has already archived, so
+        they needn't be read again.
+
+        A finished u0 holds the entries at the top of its part that aren't
+        in any of its other units.
+        """
+        self._start_journal()
+        if self.journal is None or not self.journal.done:
+            return []
+        units = self.work_units()
+        if units is None:
+            return []
+        strategy = self._get_backup_strategy()
+        rules = self.get_exclusion_rules()
+        paths = []
+        for part in self.get_parts():
+            key = checkpoint.part_key(part.name)
+            for unit in units.unit_names(key):
+                if not self.is_unit_done(os.path.basename(strategy.get_archive_base_path(part, unit))):
+                    continue
+                if unit == 'u0':
+                    in_units = units.unit_paths(key, unit)
+                    paths.extend(path for path in
+                                 self._unit_candidates(part, self.get_backup_source_root(), rules)
+                                 if path not in in_units)
+                else:
+                    paths.extend(units.unit_paths(key, unit))
+        return paths
+
+    def get_work_units(self, part):
+        """Return the names of the work units to archive part in, or [None]
+        to archive it whole.
+        """
+        units = self.work_units()
+        if units is None:
+            return [None]
+        return units.unit_names(checkpoint.part_key(part.name))
+
+    def work_units(self):
+        """Return the WorkUnits of the backup set, or None if the backup
+        isn't made in units.
+
+        They're decided at each new full backup, and used for the rest of
+        the set.  A set whose full backup wasn't made in units carries on
+        without them.
+        """
+        if not self.checkpointing():
+            return None
+        if hasattr(self, '_units_memo'):
+            return self._units_memo
+        units = None
+        if self.is_full_backup() and not (self.journal and self.journal.done):
+            units = self._split_into_units()
+            self.log.info('Work units: %r', units.units)
+            if not self._noop():
+                units.save(self.backup_set_root())
+        else:
+            units = checkpoint.WorkUnits.load(self.backup_set_root())
+            if units is None:
+                self.log.info('Backup set %r wasn\'t split into work units, '
+                              'so the backup will be made whole', self.backup_set_name())
+        self._units_memo = units
+        return units
+
+    def _split_into_units(self):
+        """Split each part's top-level entries into size-balanced units."""
+        rules = self.get_exclusion_rules()
+        root = self.get_backup_source_root()
+        sizes = {}
+        for part in self.get_parts():
+            candidates = self._unit_candidates(part, root, rules)
+            if candidates:
+                scan = estimator.ChangeScan(rules).scan(root, candidates)
+                sizes[checkpoint.part_key(part.name)] = scan.top_bytes
+        return checkpoint.WorkUnits.balanced(sizes, self.conf.checkpoint_units())
+
+    def _unit_candidates(self, part, root, rules):
+        """The entries at the top of a part that can be put in units:
+        those directly under its subdirectories, or under its root if it
+        has none, that aren't left out or on another volume.
+        """
+        candidates = []
+        for top in part.subdirs or ['']:
+            directory = os.path.join(root, top)
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                relpath = os.path.join(top, name) if top else name
+                fullpath = os.path.join(directory, name)
+                if any(_is_under(relpath, nested) for nested in part.nested):
+                    continue
+                if rules.excludes(relpath, os.path.isdir(fullpath), fullpath):
+                    continue
+                candidates.append(relpath)
+        return candidates
+
+    def get_exclusion_rules(self):
+        """Return the ExclusionRules saying what to leave out of the backup.
+        """
+        return exclusions.ExclusionRules(self.conf)
+
     def _make_backup_set(self):
         """Make the directory for the current backup set if it does not
         exist.
@@ -216,10 +598,40 @@ class BackupCopy(object):
                 self.log.info('Directory %r already exists', self.backup_set_root())
             else:
                 raise
+        if not self._noop():
+            self.rollover.remember_set(self.backup_root(), self.backup_set_name())
         return
 
 
 
+def _is_under(path, directory):
+    """Return True if the relative path is directory or somewhere under it.
+    The empty string is the root, which everything is under.
+    """
+    return not directory or path == directory or path.startswith(directory + '/')
+
+
+class BackupPart(object):
+    """One of the archives made for a backup: one per volume.
+
+    Every part's dar is run with the same -R root, the tree with all the
+    volumes mounted, so paths in all the archives are relative to it.
+
+    name: None for the main volume, else the volume's name, which is added
+          to the end of the archive name.
+    subdirs: The -g subdirectories, or the empty list for no restriction.
+    nested: Where the other volumes are mounted under this one, to be
+            left out with -P as they have archives of their own.
+    """
+    def __init__(self, name, subdirs, nested):
+        self.name = name
+        self.subdirs = subdirs
+        self.nested = nested
+
+    def __repr__(self):
+        return 'BackupPart(%r, %r, %r)' % (self.name, self.subdirs, self.nested)
+
+
 class BaseBackupStrategy(object):
     """Base backup strategy.
 
@@ -229,8 +641,9 @@ class BaseBackupStrategy(object):
      print_backup_type() - print the type (full or incremental) of backup
                            and the name of the backup archive.
                            It might also print the parent backup name.
-     get_extra_dar_args() - return any additional arguments to append to
-                            the usual dar command line.
+     get_extra_dar_args(part, unit) - return any additional arguments to
+                                      append to the usual dar command line
+                                      for the given BackupPart and work unit.
      get_archive_name() - return the full basename, with -FULL or -INC suffix.  Should usually use self.backup.archive_basename(suffix) for this.
      set_successful_backup() - call self._set_successful_backup() with appropriate arguments.
 
@@ -244,25 +657,54 @@ class BaseBackupStrategy(object):
     def run(self):
         self.backup.pre_backup()
         self.print_backup_type()
-        dar_cmd = self.base_dar_cmdline()
-        dar_cmd.extend(self.get_extra_dar_args())
-        self._print_run_cmd(dar_cmd)
+        queues = []
+        for part in self.backup.get_parts():
+            queue = []
+            for unit in self.backup.get_work_units(part):
+                key = os.path.basename(self.get_archive_base_path(part, unit))
+                if self.backup.is_unit_done(key):
+                    self.backup.log.info('Reusing %r from the unfinished backup', key)
+                    continue
+                dar_cmd = self.base_dar_cmdline(part, unit)
+                dar_cmd.extend(self.get_extra_dar_args(part, unit))
+                queue.append((key, dar_cmd))
+            queues.append(queue)
+        self._run_queues(queues)
         self.set_successful_backup()
+        self.backup.finish_journal()
 
-    def base_dar_cmdline(self):
-        basename = self.get_archive_base_path()
+    def base_dar_cmdline(self, part=None, unit=None):
+        """The dar command line to archive part, which defaults to the
+        main volume, or one work unit of it, without the strategy's extra
+        arguments.
+        """
+        if part is None:
+            part = self.backup.get_parts()[0]
+        basename = self.get_archive_base_path(part, unit)
+        subdirs = part.subdirs
+        excluded = list(part.nested)
+        if unit is not None:
+            units = self.backup.work_units()
+            paths = units.unit_paths(checkpoint.part_key(part.name), unit)
+            if unit == 'u0':
+                # The rest of the part: everything not in the other units.
+                excluded.extend(paths)
+            else:
+                subdirs = [exclusions.escape_glob(path) for path in paths]
         dar_args = ArgList(['dar'])
         # dar_args.append('-v')
         dar_args.append('-c', basename)
         dar_args.append('-R', self.backup.get_backup_source_root())
         # Don't warn before overwriting a file or slice
         dar_args.append('-w')
-        # Split into < 2GB slices so they can go on ISO9660 DVDs
-        dar_args.append('-s', '1875000000')
+        # Split into slices of SLICE_SIZE
+        dar_args.append('-s', str(SLICE_SIZE))
         # Make excluded directories as empty
         dar_args.append('-D')
-        # Use maximum gzip compression when compressing files
-        dar_args.append('-z9')
+        # Compress files with gzip, at maximum compression by default
+        level = self.backup.compression_level()
+        if level:
+            dar_args.append('-z%d' % level)
         # Don't compress files smaller than 150 bytes
         dar_args.append('-m', '150')
         # Don't compress the files matching the following patterns:
@@ -270,8 +712,14 @@ class BaseBackupStrategy(object):
             dar_args.append('-Z', pattern)
         # -g arguments restrict the subdirectories to be backed up.
         # if there are no -g arguments, all subdirectories are backed up.
-        for subdir in self._subdirs():
+        for subdir in subdirs:
             dar_args.append('-g', subdir)
+        # Other volumes mounted under this one, and other work units, have
+        # their own archives.
+        for path in excluded:
+            dar_args.append('-P', exclusions.escape_glob(path))
+        # -P, -X and cache directory tagging arguments leave things out.
+        dar_args.extend(self.backup.get_exclusion_rules().dar_args())
         return dar_args
 
     def _nocompress_patterns(self):
@@ -303,14 +751,61 @@ class BaseBackupStrategy(object):
         """
         return self.backup.get_chosen_subdirs()
 
-    def get_archive_base_path(self):
-        """Return the full path to the new archive, to be passed to dar."""
-        return os.path.join(self.backup.backup_set_root(), self.get_archive_name())
+    def get_archive_base_path(self, part=None, unit=None):
+        """Return the full path to the new archive, or to one part or work
+        unit of it, to be passed to dar."""
+        name = self.get_archive_name()
+        if part is not None:
+            name = backup_deps.part_name(name, part.name)
+        if unit is not None:
+            name = backup_deps.part_name(name, unit)
+        return os.path.join(self.backup.backup_set_root(), name)
 
     def _print_run_cmd(self, cmd):
         """Print and perhaps run the given cmd.  cmd must be a list of args"""
         self._cmd.check_call(cmd)
 
+    def _print_run_backup_cmd(self, cmd):
+        """Print and perhaps run a command that reads the source, counting
+        the bytes it reads.
+        """
+        self._cmd.check_call_counting_reads(cmd)
+
+    def bytes_read(self):
+        """How many bytes the commands run so far have read."""
+        return self._cmd.bytes_read
+
+    def _run_queues(self, queues):
+        """Print and perhaps run the queues of (unit key, command) all at
+        the same time, each queue's commands one after another, recording
+        each unit as done as its command finishes.
+
+        If any fail, no more are started, and the first failure is raised
+        once those running have finished.
+        """
+        failures = []
+        def run(queue):
+            for key, cmd in queue:
+                if failures:
+                    return
+                try:
+                    self._print_run_backup_cmd(cmd)
+                except Exception, exc:
+                    failures.append(exc)
+                    return
+                self.backup.unit_done(key)
+        queues = [queue for queue in queues if queue]
+        if len(queues) == 1:
+            run(queues[0])
+        else:
+            threads = [threading.Thread(target=run, args=(queue,)) for queue in queues]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if failures:
+            raise failures[0]
+
     def _print_cmd(self, cmd):
         """Log the command at info level."""
         self._cmd.log_cmd(cmd)
@@ -342,7 +837,7 @@ class FullBackupStrategy(BaseBackupStrategy):
         """Appropriate output information for a full backup."""
         print('Full backup: %s' % self.get_archive_name())
 
-    def get_extra_dar_args(self):
+    def get_extra_dar_args(self, part=None, unit=None):
         """No extra args required for a full backup."""
         return []
 
@@ -364,9 +859,19 @@ class IncrementalBackupStrategy(BaseBackupStrategy):
         print('Incremental backup: %s' % self.get_archive_name())
         print('Based on parent: %s' % self._get_parent_archive_name())
 
-    def get_extra_dar_args(self):
-        """Arguments to specify the parent archive."""
-        return ['-A', self._parent_archive_path()]
+    def get_extra_dar_args(self, part=None, unit=None):
+        """Arguments to specify the parent archive, or the same part or work
+        unit of it.
+
+        If the parent has no such part, because the volume has only just
+        been added to the profile, there's nothing to compare against, so
+        the part is archived in full.
+        """
+        parent_path = self._parent_archive_path(part, unit)
+        if not os.path.exists(parent_path + '.1.dar') and not self.backup._noop():
+            self.backup.log.warn('No parent archive %r, archiving this part in full', parent_path)
+            return []
+        return ['-A', parent_path]
 
     def _get_parent_archive_name(self):
         if not hasattr(self, '_parent_archive_name'):
@@ -374,11 +879,148 @@ class IncrementalBackupStrategy(BaseBackupStrategy):
             self._parent = self.backup.last_successful_backup_in_set()
         return self._parent
 
-    def _parent_archive_path(self):
-        return os.path.join(self.backup.backup_set_root(), self._get_parent_archive_name())
+    def _parent_archive_path(self, part=None, unit=None):
+        name = self._get_parent_archive_name()
+        if part is not None:
+            name = backup_deps.part_name(name, part.name)
+        if unit is not None:
+            name = backup_deps.part_name(name, unit)
+        return os.path.join(self.backup.backup_set_root(), name)
 
     def set_successful_backup(self):
         """Set successful backup with parent."""
         archive_name = self.get_archive_name()
         parent = self._get_parent_archive_name()
         self._set_successful_backup(archive_name, parent)
+
+class HardlinkBackupStrategy(BaseBackupStrategy):
+    """Copy the source into a browsable directory tree instead of a dar archive.
+
+    rsync copies the source into a new directory in the backup set, using
+    --link-dest against the previous tree so that unchanged files are hard
+    links to it rather than new copies.  That's the latest tree in the set
+    or, for the first tree in a set, the newest tree in any set.  Only the
+    first tree of all is a complete copy.
+
+    The tree is built under a .partial name and renamed when rsync
+    succeeds, so an incomplete tree is never mistaken for a backup.  Any
+    left by failed runs are removed at the start of the next.
+
+    See BaseBackupStrategy for invocation instructions.
+    """
+    def run(self):
+        self.backup.pre_backup()
+        self._remove_partial_trees()
+        self.print_backup_type()
+        partial_path = self.get_archive_base_path() + PARTIAL_SUFFIX
+        self._print_run_backup_cmd(self.rsync_cmdline(partial_path))
+        self.backup.log.info('rename %r to %r', partial_path, self.get_archive_base_path())
+        if not self.backup._noop():
+            os.rename(partial_path, self.get_archive_base_path())
+        self.set_successful_backup()
+
+    def get_archive_name(self):
+        """archive_basename + '-TREE'"""
+        return self.backup.archive_basename(backup_deps.TREE_SUFFIX)
+
+    def print_backup_type(self):
+        """Outputs info for the tree, and the tree it links to if any."""
+        print('Hard-link tree backup: %s' % self.get_archive_name())
+        if self._link_dest() is not None:
+            print('Linked to: %s' % os.path.basename(self._link_dest()))
+
+    def rsync_cmdline(self, dest):
+        """The rsync command line to copy the source into dest."""
+        source_root = self.backup.get_backup_source_root().rstrip('/')
+        rsync_args = ArgList(['rsync'])
+        # Archive mode, keeping hard links, ACLs and extended attributes
+        rsync_args.append('-aHAX')
+        rsync_args.append('--numeric-ids')
+        if self._link_dest() is not None:
+            rsync_args.append('--link-dest', self._link_dest())
+        rsync_args.extend(self._rsync_filter_args())
+        subdirs = self._subdirs()
+        if subdirs:
+            # /./ marks where the path to recreate under dest starts
+            rsync_args.append('--relative')
+            for subdir in subdirs:
+                rsync_args.append(source_root + '/./' + subdir.strip('/'))
+        else:
+            rsync_args.append(source_root + '/')
+        rsync_args.append(dest + '/')
+        return rsync_args
+
+    def _rsync_filter_args(self):
+        """The exclusion rules as rsync --exclude and --include arguments.
+
+        rsync has no equivalent of the regex or CACHEDIR.TAG rules, so
+        those are logged and ignored.
+        """
+        rules = self.backup.get_exclusion_rules()
+        if rules.regexes or rules.cachedir_tag:
+            self.backup.log.warn('[exclude] regexes and cachedir_tag are not applied to hard-link trees')
+        args = []
+        for path in rules.paths:
+            # A leading / anchors a pattern to the root of the transfer, and
+            # ** matches across slashes, as * does for dar.
+            args.extend(['--exclude', '/' + re.sub(r'\*+', '**', path.lstrip('/'))])
+        if rules.names:
+            # Names only match files, as for dar, so let every directory
+            # not already excluded through first.
+            args.extend(['--include', '*/'])
+            for name in rules.names:
+                args.extend(['--exclude', name])
+        return args
+
+    def _remove_partial_trees(self):
+        """Remove the .partial trees left in any set by failed runs."""
+        root = self.backup.backup_root()
+        for set_name in sorted(os.listdir(root)):
+            set_root = os.path.join(root, set_name)
+            if not os.path.isdir(set_root):
+                continue
+            for name in sorted(os.listdir(set_root)):
+                if name.endswith(backup_deps.TREE_SUFFIX + PARTIAL_SUFFIX):
+                    path = os.path.join(set_root, name)
+                    self.backup.log.warn('Removing %r, left by a failed backup', path)
+                    if not self.backup._noop():
+                        shutil.rmtree(path)
+
+    def _get_parent_archive_name(self):
+        """The previous tree in the set, or None if this is the first.
+
+        If the set's latest backup isn't a tree, because the strategy has
+        been changed, there's no previous tree in the set.
+        """
+        parent = self.backup.last_successful_backup_in_set()
+        if parent is None or not parent.endswith(backup_deps.TREE_SUFFIX):
+            return None
+        return parent
+
+    def _link_dest(self):
+        """The path of the tree to hard-link unchanged files to, or None if
+        there isn't one.
+
+        That's the previous tree in the set, else the newest tree in any
+        set, as long as its directory is there.
+        """
+        if not hasattr(self, '_link_dest_memo'):
+            self._link_dest_memo = None
+            candidates = []
+            if self._get_parent_archive_name() is not None:
+                candidates.append(os.path.join(self.backup.backup_set_root(),
+                                               self._get_parent_archive_name()))
+            deps = backup_deps.BackupDeps(self.backup.backup_root(), self.backup.backup_prefix())
+            candidates.extend(os.path.join(deps.set_root(entry.set_name), entry.archive)
+                              for entry in deps.entries() if entry.is_tree())
+            for path in candidates:
+                if os.path.isdir(path):
+                    self._link_dest_memo = path
+                    break
+                self.backup.log.warn('Tree %r is missing, not linking to it', path)
+        return self._link_dest_memo
+
+    def set_successful_backup(self):
+        """Set successful backup, with the previous tree in the set as parent."""
+        self._set_successful_backup(self.get_archive_name(),
+                                    self._get_parent_archive_name() or '')
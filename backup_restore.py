@@ -0,0 +1,354 @@
+#! /usr/bin/env python
+
+"""Restore single files, fetching only the archive slices that hold them.
+"""
+
+import backup_conf
+import backup_deps
+import checkpoint
+import program_runners
+import logging
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+from arglist import ArgList
+
+class RestoreFailed(Exception):
+    pass
+
+class PointRestore(object):
+    """Restore one path from the newest backup that holds its data.
+
+    The backup_deps files are used to find the newest archive and walk
+    back through its parents.  For each archive, only the slices holding
+    the catalogue (the first and the last) are fetched to list the path,
+    then only the slice(s) holding its data are fetched to extract it.
+
+    A directory's entries can have their data in any archive of the chain,
+    so each archive with anything under it saved or deleted is extracted
+    in turn, oldest first.
+
+    Hard-link tree backups are copied from directly.
+    """
+    def __init__(self, options):
+        """
+        options: The options generated by argparse.
+        """
+        self.options = options
+        self._setup_logging()
+        self._cmd = program_runners.LoggableCalls(self.log, self._noop())
+        self._staging_dir = None
+        self._listings = {}
+
+    def _setup_logging(self):
+        numeric_level = getattr(logging, self._log_level(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % self._log_level())
+        logging.basicConfig(level=numeric_level)
+        self.log = logging.getLogger(__name__)
+
+    def _log_level(self):
+        return self.options.log_level
+
+    def _noop(self):
+        return self.options.noop
+
+    def run(self):
+        """Run the restore."""
+        if self._noop():
+            self.log.warn('--noop set, won\'t do anything for real')
+        self.conf = backup_conf.BackupConf(self.options)
+        self.deps = backup_deps.BackupDeps(self._archive_root(),
+                                           self.conf.backup_archive_prefix())
+        try:
+            for entry, archive, slices in self._restore_steps():
+                print('Restoring %s from: %s' % (self._path(), archive))
+                if entry.is_tree():
+                    self._copy_from_tree(entry)
+                else:
+                    self._fetch_slices(entry.set_name, archive, slices)
+                    self._extract(archive)
+        finally:
+            self._remove_staging_dir()
+
+    def _archive_root(self):
+        """The directory to fetch archives from, as chosen by --from.
+        """
+        if self.options.source == 'rsync':
+            return self.conf.rsync_target_dir()
+        return self.conf.backup_target()
+
+    def _path(self):
+        """The path to restore, relative to the root of the backup, as dar
+        expects it.
+        """
+        return os.path.normpath(self.options.path).lstrip('/')
+
+    def _start_archive(self):
+        """The name of the archive to start looking in.
+
+        This is the one given with --archive, or the newest recorded backup.
+        """
+        if self.options.archive:
+            return self.options.archive
+        newest = self.deps.newest()
+        if newest is None:
+            raise RestoreFailed('No backups recorded under %r' % self.deps.backup_root)
+        return newest.archive
+
+    def _restore_steps(self):
+        """Return (DepsEntry, archive name, slice numbers) for each archive
+        to restore from, in the order to restore from them.
+
+        A file is restored from the newest backup in the chain that has its
+        data saved in it.  A directory is restored from every archive in
+        the chain with anything under it saved or deleted, oldest first, so
+        each backup's changes are applied over those of its parents.
+
+        The archive names are those of the part, or work units, of each
+        backup holding the path.
+        """
+        path = self._path()
+        steps = []
+        is_dir = None
+        for entry in self.deps.chain(self._start_archive()):
+            if not entry.has_archive():
+                self.log.info('%r is an unchanged restore point', entry.archive)
+                continue
+            if entry.is_tree():
+                # Complete, so nothing older is needed.
+                if os.path.lexists(self._tree_path(entry)):
+                    steps.append((entry, entry.archive, []))
+                elif not steps:
+                    raise RestoreFailed('%r is not in %s' % (path, entry.archive))
+                break
+            archives = self._archives_for_path(entry)
+            if is_dir is None:
+                # The newest backup says whether the path is there, and
+                # whether it's a directory.
+                self.log.info('Looking for %r in %r', path, archives[0])
+                listing = self._list_path(entry, archives[0], path)
+                own = [item for item in listing if item[0] == path]
+                if not own:
+                    raise RestoreFailed('%r is not in %s' % (path, entry.archive))
+                if 'REMOVED' in own[0][1]:
+                    raise RestoreFailed('%r was deleted as of %s' % (path, entry.archive))
+                is_dir = len(listing) > 1
+            if not is_dir:
+                self.log.info('Looking for %r in %r', path, archives[0])
+                status, slices = self._file_status(self._list_path(entry, archives[0], path), path)
+                if status == 'saved':
+                    return [(entry, archives[0], slices)]
+                elif status == 'removed':
+                    raise RestoreFailed('%r was deleted as of %s' % (path, entry.archive))
+                elif status == 'missing':
+                    raise RestoreFailed('%r is not in %s' % (path, entry.archive))
+                # Unchanged since the parent, so its data is further up the chain.
+                continue
+            for archive in archives:
+                self.log.info('Looking under %r in %r', path, archive)
+                changed, slices = self._tree_changes(self._list_path(entry, archive, path))
+                if changed:
+                    steps.append((entry, archive, slices))
+        if not steps:
+            raise RestoreFailed('No saved copy of %r found' % path)
+        steps.reverse()
+        return steps
+
+    def _parts_for_path(self):
+        """The names of the backup parts that could hold the path, best first.
+
+        That's the volume it's on, as the profile is configured now, then
+        the main volume, which held everything before any other volumes
+        were added to the profile.
+        """
+        path = self._path()
+        best = None
+        if self.conf.source_is_lvm():
+            for volume in self.conf.lvm_volumes():
+                if volume.mount_at and (path == volume.mount_at or path.startswith(volume.mount_at + '/')):
+                    if best is None or len(volume.mount_at) > len(best.mount_at):
+                        best = volume
+        if best is None:
+            return [None]
+        return [best.name, None]
+
+    def _archives_for_path(self, entry):
+        """Return the names of the archives in the backup that can hold the
+        path or anything under it.
+
+        That's the archive of the part holding the path or, if the set's
+        backups are made in work units, the archive of the unit holding the
+        path, followed by those of any other units with paths under it.
+        """
+        units = checkpoint.WorkUnits.load(self.deps.set_root(entry.set_name))
+        for part in self._parts_for_path():
+            archive = backup_deps.part_name(entry.archive, part)
+            if units is not None:
+                key = checkpoint.part_key(part)
+                unit = units.unit_for_path(key, self._path())
+                names = [unit] + [name for name in units.units_under(key, self._path())
+                                  if name != unit]
+                found = [backup_deps.part_name(archive, name) for name in names
+                         if self._slice_numbers(entry.set_name, backup_deps.part_name(archive, name))]
+                if found:
+                    return found
+            if self._slice_numbers(entry.set_name, archive):
+                return [archive]
+        raise RestoreFailed('No slices found for %s' % entry.archive)
+
+    def _list_path(self, entry, archive, path):
+        """Return (path, flags, slice column) for the path and every entry
+        under it in the given archive, from dar's listing.
+        """
+        if (entry.set_name, archive) in self._listings:
+            return self._listings[entry.set_name, archive]
+        self._fetch_catalogue_slices(entry.set_name, archive)
+        list_cmd = ArgList(['dar', '-Q'])
+        list_cmd.append('-l', self._reading_basename(entry.set_name, archive))
+        list_cmd.append('-Tslice')
+        list_cmd.append('-g', path)
+        self._cmd.log_cmd(list_cmd)
+        output = subprocess.check_output(list_cmd)
+        listing = []
+        for line in output.splitlines():
+            fields = line.split('|')
+            if len(fields) < 3:
+                continue
+            name = fields[-1].strip()
+            if name == path or name.startswith(path + '/') or not path:
+                listing.append((name, fields[1], fields[0]))
+        self._listings[entry.set_name, archive] = listing
+        return listing
+
+    def _file_status(self, listing, path):
+        """Return (status, slices) for the path in a listing.
+
+        status is one of 'saved', 'unchanged', 'removed' or 'missing'.
+        slices is the sorted list of slice numbers holding the data.
+        """
+        for name, flags, column in listing:
+            if name != path:
+                continue
+            if 'REMOVED' in flags:
+                return 'removed', []
+            if 'Saved' not in flags:
+                return 'unchanged', []
+            return 'saved', self._parse_slices(column)
+        return 'missing', []
+
+    def _tree_changes(self, listing):
+        """Return (changed, slices) for the entries in a listing: whether
+        any were saved or deleted in that archive, and the sorted list of
+        slice numbers holding the data of those saved.
+        """
+        changed = False
+        slices = set()
+        for name, flags, column in listing:
+            if 'REMOVED' in flags:
+                changed = True
+            elif 'Saved' in flags:
+                changed = True
+                slices.update(self._parse_slices(column))
+        return changed, sorted(slices)
+
+    def _parse_slices(self, column):
+        """Expand a dar slice column such as '3' or '2-4' into a list of
+        slice numbers.
+        """
+        slices = set()
+        for first, last in re.findall(r'(\d+)(?:-(\d+))?', column):
+            first = int(first)
+            last = int(last or first)
+            slices.update(range(first, last + 1))
+        return sorted(slices)
+
+    def _slice_numbers(self, set_name, archive):
+        """Return the sorted list of slice numbers present for an archive
+        in the archive root, which is empty if there are none.
+        """
+        pattern = re.compile(r'^%s\.(\d+)\.dar$' % re.escape(archive))
+        numbers = []
+        for filename in os.listdir(self.deps.set_root(set_name)):
+            match = pattern.match(filename)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _slice_filename(self, archive, number):
+        return '%s.%d.dar' % (archive, number)
+
+    def _fetch_catalogue_slices(self, set_name, archive):
+        """Fetch the slices dar needs to read the catalogue of an archive:
+        the first for the archive header and the last for the catalogue.
+        """
+        numbers = self._slice_numbers(set_name, archive)
+        if not numbers:
+            raise RestoreFailed('No slices found for %s' % archive)
+        self._fetch_slices(set_name, archive, set([numbers[0], numbers[-1]]))
+
+    def _fetch_slices(self, set_name, archive, numbers):
+        """Copy the given slices of an archive into the staging directory,
+        skipping any that have already been fetched.
+
+        With --noop nothing is copied, and dar reads straight from the
+        archive root instead.
+        """
+        for number in sorted(numbers):
+            filename = self._slice_filename(archive, number)
+            staged = os.path.join(self._get_staging_dir(), filename)
+            if os.path.exists(staged):
+                continue
+            source = os.path.join(self.deps.set_root(set_name), filename)
+            self._cmd.check_call(['cp', source, staged])
+
+    def _reading_basename(self, set_name, archive):
+        """The basename dar should read the archive from."""
+        if self._noop():
+            return os.path.join(self.deps.set_root(set_name), archive)
+        return os.path.join(self._get_staging_dir(), archive)
+
+    def _extract(self, archive):
+        """Extract the path from the fetched slices into the destination.
+
+        With --noop, the archive is read where it is, so this only logs.
+        """
+        extract_cmd = ArgList(['dar', '-Q'])
+        extract_cmd.append('-x', os.path.join(self._get_staging_dir(), archive))
+        extract_cmd.append('-R', self.options.dest)
+        # Don't warn before overwriting
+        extract_cmd.append('-w')
+        extract_cmd.append('-g', self._path())
+        self._cmd.check_call(extract_cmd)
+
+    def _tree_path(self, entry):
+        """Where the path is in a hard-link tree backup."""
+        return os.path.join(self.deps.set_root(entry.set_name), entry.archive, self._path())
+
+    def _copy_from_tree(self, entry):
+        """Copy the path straight out of a hard-link tree into the destination.
+        """
+        tree = os.path.join(self.deps.set_root(entry.set_name), entry.archive)
+        rsync_cmd = ArgList(['rsync', '-aHAX', '--numeric-ids'])
+        # /./ marks where the path to recreate under dest starts
+        rsync_cmd.append('--relative', tree + '/./' + self._path())
+        rsync_cmd.append(self.options.dest.rstrip('/') + '/')
+        self._cmd.check_call(rsync_cmd)
+
+    def _get_staging_dir(self):
+        if self._staging_dir is None:
+            if self._noop():
+                self._staging_dir = os.path.join(tempfile.gettempdir(), 'a_temporary_directory')
+            else:
+                self._staging_dir = tempfile.mkdtemp(prefix='restore-')
+        return self._staging_dir
+
+    def _remove_staging_dir(self):
+        if self._staging_dir is not None:
+            self.log.info('remove directory %r', self._staging_dir)
+            if not self._noop():
+                shutil.rmtree(self._staging_dir)
+            self._staging_dir = None
@@ -6,6 +6,14 @@
 import backup_conf
 import backup_operation
 import program_runners
+import write_counters
+import exclusions
+import s3_target
+import estimator
+import locks
+import prefetch
+import quiesce
+import datetime
 import logging
 import os
 import os.path
@@ -18,6 +26,9 @@ try:
 except ImportError:
     import StringIO as stringio
 
+# Number of subtrees to list in each part of the exclusion report
+REPORT_LINES = 20
+
 class UnmountFailed(Exception):
     pass
 
@@ -31,6 +42,7 @@ class BackupScript(object):
         self.options = options
         self._setup_logging()
         self._mountpoint = None
+        self._write_counters = None
         self._cmd = program_runners.LoggableCalls(self.log, self._noop())
 
     def _setup_logging(self):
@@ -51,36 +63,142 @@ class BackupScript(object):
         if self._noop():
             self.log.warn('--noop set, won\'t do anything for real')
         self._read_config()
+        lock = locks.ProfileLock(self.conf.backup_target())
+        slot = None
+        if not self._noop():
+            # Raises AlreadyRunning rather than clean up after a backup
+            # that's still going.
+            lock.acquire()
+        try:
+            if self.options.take_slot:
+                slot = self._take_slot()
+            self._run_locked()
+        finally:
+            if slot is not None:
+                slot.release()
+            lock.release()
+
+    def _take_slot(self):
+        """Take one of the [schedule] slots for the backup's target, held
+        until the backup finishes, or raise NoSlotFree.
+        """
+        slots = locks.TargetSlots(self.conf.schedule_slots_dir(),
+                                  self.conf.schedule_target_slots())
+        slot = slots.acquire()
+        if slot is None:
+            raise locks.NoSlotFree('no slot is free in %s' % slots.directory)
+        self.log.info('Took %r', slot)
+        return slot
+
+    def _run_locked(self):
+        """Run the script, holding the profile's lock."""
         self._cleanup_last_time()
+        if self.options.exclusion_report:
+            self._run_exclusion_report()
+            return
+        if self._source_unchanged():
+            self._rsync_archives()
+            self._upload_archives()
+            return
         try:
             self._prepare_for_backup()
             self._do_backup()
         finally:
             self._post_backup_cleanup()
             self._rsync_archives()
+        # Only after a successful backup, so an upload failure can't hide
+        # why the backup failed.
+        self._upload_archives()
 
     def _read_config(self):
         """Read the configuration.
         """
         self.conf = backup_conf.BackupConf(self.options)
+        # Raises ValueError for a strategy that can't be used, before
+        # anything's been snapshotted.
+        self.conf.backup_strategy()
 
     def _cleanup_last_time(self):
         """Clean up any left-overs from last time.
         """
         self.log.info("Cleanup from last time")
-        if self._snapshot_exists():
+        if self._existing_snapshots():
+            self._unmount_leftovers()
             self._post_backup_cleanup()
 
-    def _snapshot_exists(self):
-        lv_pair = [self.conf.lvm_snapshot_lv_name(), self.conf.lvm_vg()]
-        found = False
-        for record in self._list_current_lvs():
-            if record[:2] == lv_pair:
-                found = record
-                break
-        if found and found[4] != self.conf.lvm_lv():
-            raise RuntimeError('Logical volume %r exists, but is not a snapshot of %r.' % (self.conf.lvm_snapshot_lv_name(), self.conf.lvm_lv()))
-        return bool(found)
+    def _source_unchanged(self):
+        """If configured to do so, check whether the source volume has been
+        written to since the last successful backup.
+
+        If it hasn't, an unchanged restore point is recorded and True is
+        returned, meaning there's no need to snapshot or run dar.
+        """
+        if not self.conf.skip_unchanged():
+            return False
+        if not self.conf.should_snapshot_source():
+            self.log.info("Not an LVM source, can't check write counters")
+            return False
+        if self.conf.bindmounts_equals():
+            self.log.info("Bind mounts configured, can't check write counters")
+            return False
+        backup = backup_operation.BackupCopy(
+                options=self.options,
+                config=self.conf,
+        )
+        if backup.is_full_backup():
+            return False
+        self._sync_sources()
+        counters = write_counters.WriteCounters.for_volumes(self._volume_devices())
+        previous = backup.last_write_counters()
+        self.log.info("Write counters now %r, last backup %r", counters, previous)
+        if not counters.unchanged_since(previous):
+            return False
+        self.log.info("Source volume unchanged, skipping snapshot and backup")
+        backup.record_unchanged_backup()
+        backup.record_run(datetime.datetime.now(), 'unchanged')
+        return True
+
+    def _sync_sources(self):
+        """Flush the source volumes' mounted filesystems, so writes still in
+        the page cache are counted before the write counters are read.
+        """
+        for volume in self._volumes():
+            for mountpoint in self._mount_points_of(volume.source_device())[:1]:
+                self.log.info("Sync %r", mountpoint)
+                write_counters.sync_filesystem(mountpoint)
+
+    def _volumes(self):
+        """The LvmVolumes to snapshot, in the order to mount them: the main
+        volume first, then any others, outermost first.
+        """
+        if not self.conf.should_snapshot_source():
+            return []
+        return sorted(self.conf.lvm_volumes(),
+                      key=lambda volume: (volume.mount_at != '', volume.mount_at.count('/')))
+
+    def _volume_devices(self):
+        """(name, source device) for each volume, for reading write counters."""
+        return [(volume.name, volume.source_device()) for volume in self._volumes()]
+
+    def _existing_snapshots(self):
+        """Return the LvmVolumes whose snapshots currently exist.
+
+        RuntimeError is raised if a logical volume with a snapshot's name
+        exists but isn't a snapshot of the right volume.
+        """
+        if not self.conf.should_snapshot_source():
+            return []
+        records = self._list_current_lvs()
+        existing = []
+        for volume in self._volumes():
+            lv_pair = [volume.snapshot_lv_name, volume.vg]
+            for record in records:
+                if record[:2] == lv_pair:
+                    if record[4] != volume.lv:
+                        raise RuntimeError('Logical volume %r exists, but is not a snapshot of %r.' % (volume.snapshot_lv_name, volume.lv))
+                    existing.append(volume)
+                    break
+        return existing
 
     def _list_current_lvs(self):
         lvs_cmd = ['lvs', '--separator', ',', '--noheadings']
@@ -99,21 +217,110 @@ class BackupScript(object):
         self._mount_binds()
 
     def _make_lvm_snapshot(self):
-        """Make the LVM snapshot.
+        """Make the LVM snapshots, one straight after another.
+
+        Any [quiesce:name] hooks are run first, all at once, and released
+        as soon as the snapshots exist.  They're not run for an exclusion
+        report, which doesn't need the applications' data consistent.
+
+        If [lvm] fsfreeze is set, the source filesystems are all frozen
+        while the snapshots are made, so they're consistent with each other.
+        lvcreate is told not to back up or archive the LVM metadata while
+        they're frozen, in case /etc/lvm is on one of them, so it's backed
+        up with vgcfgbackup after.
         """
         if not self.conf.should_snapshot_source():
             self.log.info("LVM snapshots disabled")
             return
-        self.log.info("Make temporary LVM snapshot")
+        self.log.info("Make temporary LVM snapshot(s)")
+        volumes = self._volumes()
+        self._read_write_counters()
+        freeze = self.conf.lvm_fsfreeze()
+        frozen = []
+        hooks = self.conf.quiesce_hooks()
+        if self.options.exclusion_report:
+            hooks = []
+        quiescer = quiesce.Quiescer(hooks, self.log, self._noop())
+        quiescer.quiesce()
+        try:
+            if freeze:
+                frozen = self._freeze_filesystems(volumes)
+            started = time.time()
+            for volume in volumes:
+                self._make_volume_snapshot(volume, autobackup=not freeze)
+            self.log.info("Made %d snapshot(s) in %d ms", len(volumes),
+                          (time.time() - started) * 1000)
+        finally:
+            try:
+                self._thaw_filesystems(frozen)
+            finally:
+                quiescer.release()
+        if freeze:
+            for vg in sorted(set(volume.vg for volume in volumes)):
+                self._print_run_cmd(['vgcfgbackup', vg])
+
+    def _make_volume_snapshot(self, volume, autobackup=True):
         lvcreate_cmd = ['lvcreate']
-        lvcreate_cmd.extend(['--size', self.conf.lvm_snapshot_size()])
+        lvcreate_cmd.extend(['--size', volume.snapshot_size])
         lvcreate_cmd.append('--snapshot')
-        lvcreate_cmd.extend(['--name', self.conf.lvm_snapshot_lv_name()])
-        path = self._source_lvm_device()
-        lvcreate_cmd.append(path)
+        lvcreate_cmd.extend(['--name', volume.snapshot_lv_name])
+        if not autobackup:
+            # Don't write to /etc/lvm, which may be on a frozen filesystem.
+            lvcreate_cmd.extend(['--config', 'backup { backup = 0 archive = 0 }'])
+        lvcreate_cmd.append(volume.source_device())
         self._print_run_cmd(lvcreate_cmd)
 
+    def _freeze_filesystems(self, volumes):
+        """Freeze the mounted filesystems of the given volumes, returning the
+        mount points frozen.
+
+        If one can't be frozen, those already frozen are thawed again.
+        """
+        frozen = []
+        self._frozen_at = time.time()
+        try:
+            for volume in volumes:
+                # Freezing any one mount point freezes the whole filesystem.
+                for mountpoint in self._mount_points_of(volume.source_device())[:1]:
+                    self._print_run_cmd(['fsfreeze', '--freeze', mountpoint])
+                    frozen.append(mountpoint)
+        except Exception:
+            self._thaw_filesystems(frozen)
+            raise
+        return frozen
+
+    def _thaw_filesystems(self, frozen):
+        """Thaw the frozen mount points, trying them all even if some fail.
+        """
+        if not frozen:
+            return
+        failures = []
+        for mountpoint in reversed(frozen):
+            try:
+                self._print_run_cmd(['fsfreeze', '--unfreeze', mountpoint])
+            except Exception, exc:
+                failures.append(exc)
+        self.log.info("Filesystems frozen for %d ms", (time.time() - self._frozen_at) * 1000)
+        if failures:
+            raise failures[0]
+
+    def _read_write_counters(self):
+        """Read the source volume's write counters, to be saved if the backup
+        succeeds.
+
+        They're read just before quiescing and making the snapshots, after
+        syncing the source, so anything written from then on is in this
+        backup and also counts as a change next time.  The writes made by
+        quiescing, freezing and snapshotting only cause one backup more
+        than needed, whereas counters read after the snapshot could miss
+        writes that aren't in it.
+        """
+        self._sync_sources()
+        self._write_counters = write_counters.WriteCounters.for_volumes(self._volume_devices())
+        self.log.debug("Write counters before snapshot: %r", self._write_counters)
+
     def _source_lvm_device(self):
+        """The device of the main volume."""
         return os.path.join('/dev', self.conf.lvm_vg(), self.conf.lvm_lv())
 
     def _print_run_cmd(self, cmd):
@@ -123,22 +330,17 @@ class BackupScript(object):
         self._cmd.log_cmd(cmd)
 
     def _mount_lvm_snapshot(self):
-        """Mount the LVM snapshot
+        """Mount the LVM snapshots, the main one at the temporary mount point
+        and any others at their mount_at directories under it.
         """
         if not self.conf.should_snapshot_source():
             return
-        self.log.info("Mount temporary LVM snapshot")
-        mount_cmd = ['mount']
-        mount_cmd.append(self._get_snapshot_lvm_device())
-        mount_cmd.append(self._temp_mount_point())
-        self._print_run_cmd(mount_cmd)
-
-    def _get_snapshot_lvm_device(self):
-        return os.path.join('/dev', self.conf.lvm_vg(),
-                                    self.conf.lvm_snapshot_lv_name())
-
-    def _get_snapshot_lvm_volpath(self):
-        return self.conf.lvm_vg() + '/' + self.conf.lvm_snapshot_lv_name()
+        self.log.info("Mount temporary LVM snapshot(s)")
+        for volume in self._volumes():
+            mount_cmd = ['mount']
+            mount_cmd.append(volume.snapshot_device())
+            mount_cmd.append(self._get_dir_in_mount_root(volume.mount_at))
+            self._print_run_cmd(mount_cmd)
 
     def _temp_mount_point(self):
         if self._mountpoint is None:
@@ -176,7 +378,185 @@ class BackupScript(object):
                 config=self.conf,
                 backup_source_root=self._temp_mount_point()
         )
-        backup.run()
+        if self._noop():
+            self._estimate(backup)
+        started = datetime.datetime.now()
+        prefetcher = self._start_prefetch(backup)
+        try:
+            backup.run()
+        except Exception:
+            backup.record_run(started, 'failed')
+            raise
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
+        if self._write_counters is not None:
+            backup.set_write_counters(self._write_counters)
+        backup.record_run(started, 'ok')
+
+    def _estimate(self, backup):
+        """Scan for changes and print the estimate for the backup.
+
+        This is only done with --noop, as a real backup would be slowed
+        by walking the tree before dar does.  If the scan fails, that's
+        logged, and the rest of the --noop run carries on.
+        """
+        try:
+            self._print_estimate(backup, self._scan_changes(backup))
+        except Exception, exc:
+            self.log.error("Can't estimate the backup of %s: %s", self.options.specfile, exc)
+
+    def _scan_changes(self, backup):
+        """Scan the tree to be backed up for files changed since the parent
+        backup, and return the ChangeScan.
+
+        With --noop, the source volume is scanned where it's mounted already.
+        """
+        root = self._walk_root()
+        self.log.info("Scan %r for changes", root)
+        scan = estimator.ChangeScan(backup.get_exclusion_rules(), backup.changed_since())
+        return scan.scan(root, self.conf.backup_subdirs())
+
+    def _start_prefetch(self, backup):
+        """If configured to do so, start prefetching the files the backup
+        will read, and return the Prefetcher.  Otherwise return None.
+        """
+        if not self.conf.prefetch_enabled():
+            return None
+        if self._noop():
+            self.log.info("--noop set, not prefetching")
+            return None
+        if not prefetch.available():
+            self.log.warn("readahead() isn't available, not prefetching")
+            return None
+        self.log.info("Start prefetching %r", self._temp_mount_point())
+        prefetcher = prefetch.Prefetcher(
+                root=self._temp_mount_point(),
+                rules=backup.get_exclusion_rules(),
+                since=backup.changed_since(),
+                subdirs=self.conf.backup_subdirs(),
+                window_bytes=self.conf.prefetch_window_mb() * 1024 * 1024,
+                min_available_bytes=self.conf.prefetch_min_available_mb() * 1024 * 1024,
+                logger=self.log,
+                skip=backup.done_unit_paths(),
+        )
+        prefetcher.start()
+        return prefetcher
+
+    def _print_estimate(self, backup, scan):
+        """Print predictions for the backup, based on the scan and the
+        previous runs in the run history.
+        """
+        estimate = estimator.Estimate(
+                scan,
+                backup.run_history(),
+                backup.backup_kind(),
+                backup_operation.SLICE_SIZE,
+                backup.backup_root(),
+        )
+        print('Estimate for %s (%s backup):' % (self.options.specfile, estimate.kind))
+        print('  Changed: %d of %d files, %s of %s' % (
+                scan.changed_files, scan.total_files,
+                exclusions.human_size(scan.changed_bytes),
+                exclusions.human_size(scan.total_bytes)))
+        if estimate.ratio_from_history:
+            ratio_source = 'from previous runs'
+        else:
+            ratio_source = 'no history, assumed'
+        print('  Archive size: %s in %d slice(s) (compression ratio %.2f, %s)' % (
+                exclusions.human_size(estimate.archive_bytes()),
+                estimate.slices(), estimate.ratio, ratio_source))
+        seconds = estimate.seconds()
+        if seconds is None:
+            print('  Duration: unknown until a backup has been recorded')
+        else:
+            print('  Duration: %s (at %s/s)' % (
+                    estimator.format_seconds(seconds),
+                    exclusions.human_size(estimate.throughput)))
+        print('  Target free space: %s%s' % (
+                exclusions.human_size(estimate.target_free),
+                '' if estimate.fits() else '  ** NOT ENOUGH **'))
+
+    def _run_exclusion_report(self):
+        """Prepare as for a backup, but instead of backing up, report the
+        largest subtrees the exclusions would leave out and keep in.
+        """
+        try:
+            self._prepare_for_backup()
+            self._report_exclusions(self._walk_root())
+        finally:
+            self._post_backup_cleanup()
+
+    def _report_exclusions(self, root):
+        """Print the exclusion report for the tree under root.
+        """
+        self.log.info("Report on exclusions under %r", root)
+        rules = exclusions.ExclusionRules(self.conf)
+        report = exclusions.ExclusionReport(rules)
+        included = report.walk(root, self.conf.backup_subdirs())
+        print('Included: %s' % exclusions.human_size(included))
+        print('Excluded: %s' % exclusions.human_size(report.excluded_total()))
+        print('Largest excluded subtrees:')
+        for size, path in report.largest_excluded(REPORT_LINES):
+            print('  %8s  %s' % (exclusions.human_size(size), path))
+        print('Largest included subtrees:')
+        for size, path in report.largest_included(REPORT_LINES):
+            print('  %8s  %s' % (exclusions.human_size(size), path))
+
+    def _walk_root(self):
+        """The directory to look in to see what would be backed up.
+
+        With --noop nothing gets mounted, so the source volume is looked at
+        where it's mounted already instead of through the snapshot.
+        """
+        if not self.conf.should_snapshot_source():
+            return self.conf.backup_source_root()
+        if self._noop():
+            return self._live_mount_point()
+        return self._temp_mount_point()
+
+    def _live_mount_point(self):
+        """Return where the main source logical volume is currently mounted.
+
+        RuntimeError is raised if it isn't mounted.
+        """
+        mountpoints = self._mount_points_of(self._source_lvm_device())
+        if not mountpoints:
+            raise RuntimeError('%r is not mounted' % self._source_lvm_device())
+        return mountpoints[0]
+
+    def _mount_points_of(self, device):
+        """Return the list of places the device is currently mounted."""
+        device = os.path.realpath(device)
+        return [mountpoint for (mounted, mountpoint) in self._read_mounts()
+                if os.path.realpath(mounted) == device]
+
+    def _read_mounts(self):
+        """Return (device, mount point) for everything currently mounted."""
+        mounts = []
+        with open('/proc/mounts') as mountsf:
+            for line in mountsf:
+                fields = line.split()
+                # /proc/mounts escapes spaces etc as octal
+                mounts.append((fields[0], fields[1].decode('string_escape')))
+        return mounts
+
+    def _unmount_leftovers(self):
+        """Unmount the snapshots left mounted by a previous run that didn't
+        finish, and anything mounted under them, innermost first.
+        """
+        snapshot_devices = set(os.path.realpath(volume.snapshot_device())
+                               for volume in self._volumes())
+        roots = [mountpoint for (device, mountpoint) in self._read_mounts()
+                 if os.path.realpath(device) in snapshot_devices]
+        leftovers = set(roots)
+        for device, mountpoint in self._read_mounts():
+            for root in roots:
+                if mountpoint.startswith(root.rstrip('/') + '/'):
+                    leftovers.add(mountpoint)
+        for mountpoint in sorted(leftovers, key=len, reverse=True):
+            self.log.info("Unmount left-over %r", mountpoint)
+            self._unmount(mountpoint)
 
     def _unmount(self, mountpoint):
         """Mount with a backoff, so it's less likely to fail completely.
@@ -222,10 +602,22 @@ class BackupScript(object):
 
     def _post_backup_cleanup(self):
         """Remove any temporary stuff from this backup.
+
+        Every step is tried even if earlier ones fail, so that as much as
+        possible is cleaned up whichever step of the backup failed.  The
+        first failure is raised at the end.
         """
-        self._unmount_binds()
-        self._unmount_lvm_snapshot()
-        self._remove_lvm_snapshot()
+        failures = []
+        for step in (self._unmount_binds,
+                     self._unmount_lvm_snapshot,
+                     self._remove_lvm_snapshot):
+            try:
+                step()
+            except Exception, exc:
+                self.log.error("%s failed: %s", step.__name__, exc)
+                failures.append(exc)
+        if failures:
+            raise failures[0]
 
     def _unmount_binds(self):
         """Unmount any bind mounts.
@@ -240,9 +632,12 @@ class BackupScript(object):
 
 
     def _unmount_lvm_snapshot(self):
-        """Unmount any LVM snapshots.
+        """Unmount any LVM snapshots, innermost first.
         """
-        self.log.info("Unmount the temporary LVM snapshot")
+        self.log.info("Unmount the temporary LVM snapshot(s)")
+        for volume in reversed(self._volumes()):
+            if volume.mount_at:
+                self._unmount(self._get_dir_in_mount_root(volume.mount_at))
         self._unmount(self._temp_mount_point())
         self._remove_temp_mount_point()
 
@@ -255,13 +650,25 @@ class BackupScript(object):
             self._mountpoint = None
 
     def _remove_lvm_snapshot(self):
-        """Remove any LVM snapshots.
+        """Remove any LVM snapshots that exist, trying them all even if
+        some fail.
         """
-        self.log.info("Remove the temporary LVM snapshot")
-        lvremove_cmd = ['lvremove']
-        lvremove_cmd.append('--force')  # remove active volume without confirmation
-        lvremove_cmd.append(self._get_snapshot_lvm_volpath())
-        self._print_run_cmd(lvremove_cmd)
+        self.log.info("Remove the temporary LVM snapshot(s)")
+        if self._noop():
+            volumes = self._volumes()
+        else:
+            volumes = self._existing_snapshots()
+        failures = []
+        for volume in volumes:
+            lvremove_cmd = ['lvremove']
+            lvremove_cmd.append('--force')  # remove active volume without confirmation
+            lvremove_cmd.append(volume.snapshot_volpath())
+            try:
+                self._print_run_cmd(lvremove_cmd)
+            except Exception, exc:
+                failures.append(exc)
+        if failures:
+            raise failures[0]
 
     def _rsync_archives(self):
         """If configured to do so, synchronise archives to somewhere else.
@@ -274,7 +681,9 @@ class BackupScript(object):
         self.log.info('rsync source: %r', source_dir)
         target_dir = self.conf.rsync_target_dir()
         self.log.info('rsync target: %r', target_dir)
-        rsync_cmd = ['rsync', '-a', '-v', source_dir, target_dir]
+        # -H keeps the files hard-linked between hard-link trees as
+        # links on the mirror too, rather than copying each tree in full.
+        rsync_cmd = ['rsync', '-a', '-H', '-v', source_dir, target_dir]
         self._print_run_cmd(rsync_cmd)
 
     def _get_rsync_source_dir(self):
@@ -282,3 +691,14 @@ class BackupScript(object):
         if not path.endswith('/'):
             path += '/'
         return path
+
+    def _upload_archives(self):
+        """If configured to do so, upload archives to an S3-compatible
+        object store.
+        """
+        if not self.conf.s3_enabled():
+            self.log.info('s3 upload not requested in config file')
+            return
+        self.log.info('uploading backups to s3...')
+        target = s3_target.S3Target(self.conf, self.log, self._noop())
+        target.upload_all(self.conf.backup_target())
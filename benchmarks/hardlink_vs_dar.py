@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+"""Compare the hardlink strategy with the dar strategy.
+
+Makes a synthetic source tree, backs it up with each strategy (a full,
+then a number of incrementals, changing a percentage of the files in
+between) and reports the run time, inodes and space used on the target,
+and how long it takes to restore one file with the restore script.
+
+Needs dar and rsync on the PATH.  Run from anywhere, e.g.:
+
+    python benchmarks/hardlink_vs_dar.py --files 20000 --rounds 5
+"""
+
+import os
+import os.path
+import sys
+import time
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import backup_conf
+import backup_operation
+import backup_restore
+
+CONFIG_TEMPLATE = """
+[backup]
+source_type = dir
+source_root = %(source)s
+target = %(target)s
+archive_prefix = bench-
+strategy = %(strategy)s
+"""
+
+def main(options):
+    """Main program."""
+    for program in ('dar', 'rsync'):
+        if find_executable(program) is None:
+            sys.exit('%s is needed on the PATH for this benchmark' % program)
+    workdir = tempfile.mkdtemp(prefix='bench-', dir=options.workdir)
+    try:
+        source = os.path.join(workdir, 'source')
+        make_tree(source, options.files, options.size_kb)
+        results = []
+        for strategy in ('dar', 'hardlink'):
+            results.append(bench_strategy(workdir, source, strategy, options))
+        report(results)
+    finally:
+        shutil.rmtree(workdir)
+
+def make_tree(root, files, size_kb):
+    """Make files files of size_kb KB each, 100 to a directory."""
+    for number in range(files):
+        path = file_path(root, number)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        write_file(path, size_kb)
+
+def file_path(root, number):
+    return os.path.join(root, 'd%04d' % (number // 100), 'f%06d' % number)
+
+def write_file(path, size_kb):
+    # Half random, half zeros, so there's something for dar to compress.
+    with open(path, 'wb') as fobj:
+        fobj.write(os.urandom(size_kb * 512))
+        fobj.write('\0' * (size_kb * 512))
+
+def change_files(root, files, percent, size_kb, seed):
+    """Rewrite percent% of the files, returning the numbers changed."""
+    rand = random.Random(seed)
+    changed = rand.sample(range(files), max(1, files * percent // 100))
+    for number in changed:
+        write_file(file_path(root, number), size_kb)
+    return changed
+
+def bench_strategy(workdir, source, strategy, options):
+    """Back up with the given strategy and return a dict of results."""
+    target = os.path.join(workdir, 'target-' + strategy)
+    os.mkdir(target)
+    specfile = os.path.join(workdir, strategy + '.ini')
+    with open(specfile, 'w') as specf:
+        specf.write(CONFIG_TEMPLATE % {'source': source, 'target': target,
+                                       'strategy': strategy})
+    run_options = argparse.Namespace(specfile=specfile, log_level='WARNING', noop=False)
+    conf = backup_conf.BackupConf(run_options)
+    inodes_before = free_inodes(target)
+    start_date = datetime.datetime.now()
+    times = []
+    changed = []
+    for run in range(options.rounds + 1):
+        if run:
+            changed = change_files(source, options.files, options.change_percent,
+                                   options.size_kb, run)
+            # Make sure the changes are newer than the parent backup's time.
+            time.sleep(1)
+        backup = backup_operation.BackupCopy(run_options, conf, backup_source_root=source)
+        # One minute apart, as archive names are only to the minute.
+        backup.backup_date = start_date + datetime.timedelta(minutes=run)
+        started = time.time()
+        backup.run()
+        times.append(time.time() - started)
+    return {
+        'strategy': strategy,
+        'full_seconds': times[0],
+        'incremental_seconds': sum(times[1:]) / max(1, len(times) - 1),
+        'inodes': inodes_before - free_inodes(target),
+        'bytes': tree_bytes(target),
+        'restore_seconds': time_restore(workdir, run_options,
+                                        os.path.relpath(file_path(source, changed[0]), source)),
+    }
+
+def time_restore(workdir, run_options, path):
+    """Time restoring one path with the restore script's PointRestore."""
+    dest = tempfile.mkdtemp(dir=workdir)
+    restore_options = argparse.Namespace(
+            specfile=run_options.specfile, log_level='WARNING', noop=False,
+            source='target', archive=None, dest=dest, path=path)
+    started = time.time()
+    backup_restore.PointRestore(restore_options).run()
+    return time.time() - started
+
+def free_inodes(path):
+    return os.statvfs(path).f_ffree
+
+def tree_bytes(root):
+    """Space used under root, counting each hard-linked inode once."""
+    seen = set()
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames + dirnames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if st.st_ino not in seen:
+                seen.add(st.st_ino)
+                total += st.st_blocks * 512
+    return total
+
+def report(results):
+    print('%-10s %10s %10s %10s %12s %10s' % (
+            'strategy', 'full s', 'inc s', 'inodes', 'MB used', 'restore s'))
+    for result in results:
+        print('%-10s %10.2f %10.2f %10d %12.1f %10.3f' % (
+                result['strategy'], result['full_seconds'],
+                result['incremental_seconds'], result['inodes'],
+                result['bytes'] / 1048576.0, result['restore_seconds']))
+
+def get_options():
+    """Get options for the script."""
+    parser = argparse.ArgumentParser(
+               description="benchmark the hardlink strategy against dar",
+             )
+    parser.add_argument('--files', type=int, default=5000,
+            help='number of files in the source tree.  Default: 5000')
+    parser.add_argument('--size-kb', type=int, default=16,
+            help='size of each file in KB.  Default: 16')
+    parser.add_argument('--rounds', type=int, default=3,
+            help='number of incremental backups after the full.  Default: 3')
+    parser.add_argument('--change-percent', type=int, default=2,
+            help='percentage of files changed before each incremental.  Default: 2')
+    parser.add_argument('--workdir', default=None,
+            help='where to make the temporary files.  Default: system temp dir')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(get_options())
@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+
+"""Compare full backup wall time with and without the prefetcher.
+
+Makes an ext4 image on a loop device, fills it with files whose blocks
+are interleaved on disk (as a long-lived filesystem's are), then backs
+it up with dar, alternately with and without prefetching, dropping the
+page cache before each run.
+
+The loop device inherits the seek behaviour of the disk the image is on,
+so put --workdir on the spinning disk you want to measure.  dar doesn't
+compress by default here (--compression-level), so the runs are bound by
+reading the files rather than by gzip, which would hide the seeks.
+
+Needs root, mkfs.ext4 and dar.  Run from anywhere, e.g.:
+
+    sudo python benchmarks/prefetch_loopback.py --workdir /scratch --size-mb 4096
+"""
+
+import os
+import os.path
+import sys
+import time
+import random
+import shutil
+import logging
+import argparse
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import backup_conf
+import backup_operation
+import prefetch
+
+CONFIG_TEMPLATE = """
+[backup]
+source_type = dir
+source_root = %(source)s
+target = %(target)s
+archive_prefix = bench-
+compression_level = %(compression_level)d
+"""
+
+def main(options):
+    """Main program."""
+    if os.geteuid() != 0:
+        sys.exit('this benchmark needs root, to mount the image and drop caches')
+    for program in ('dar', 'mkfs.ext4'):
+        if find_executable(program) is None:
+            sys.exit('%s is needed on the PATH for this benchmark' % program)
+    if not prefetch.available():
+        sys.exit("readahead() isn't available here")
+    workdir = tempfile.mkdtemp(prefix='bench-', dir=options.workdir)
+    mountpoint = os.path.join(workdir, 'mnt')
+    image = os.path.join(workdir, 'ext4.img')
+    os.mkdir(mountpoint)
+    try:
+        make_image(image, options.size_mb)
+        mount(image, mountpoint)
+        try:
+            fill(mountpoint, options.files, options.size_mb * 1024 * 7 // 10 // options.files)
+            results = {False: [], True: []}
+            for run in range(options.repeat):
+                for with_prefetch in (False, True):
+                    umount(mountpoint)
+                    drop_caches()
+                    mount(image, mountpoint)
+                    seconds = bench_backup(workdir, mountpoint, with_prefetch, options)
+                    results[with_prefetch].append(seconds)
+                    print('run %d %-16s %8.2fs' % (run + 1,
+                            'with prefetch' if with_prefetch else 'without', seconds))
+        finally:
+            umount(mountpoint)
+        report(results)
+    finally:
+        shutil.rmtree(workdir)
+
+def make_image(image, size_mb):
+    with open(image, 'wb') as imgf:
+        imgf.truncate(size_mb * 1024 * 1024)
+    subprocess.check_call(['mkfs.ext4', '-q', '-F', image])
+
+def mount(image, mountpoint):
+    subprocess.check_call(['mount', '-o', 'loop', image, mountpoint])
+
+def umount(mountpoint):
+    subprocess.check_call(['umount', mountpoint])
+
+def drop_caches():
+    subprocess.check_call(['sync'])
+    with open('/proc/sys/vm/drop_caches', 'w') as dropf:
+        dropf.write('3\n')
+
+def fill(root, files, size_kb):
+    """Make files files of about size_kb KB, 100 to a directory, written a
+    64KB chunk at a time to a random one of them, so their blocks end up
+    interleaved rather than in directory order.
+
+    The chunks are text-like, so they compress about as well as a system
+    volume's files do when --compression-level is given.
+    """
+    rand = random.Random(0)
+    words = ['%x' % rand.getrandbits(rand.randint(4, 40)) for _ in range(4096)]
+    paths = []
+    for number in range(files):
+        path = os.path.join(root, 'd%04d' % (number // 100), 'f%06d' % number)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        paths.append(path)
+    remaining = dict((path, size_kb // 64 or 1) for path in paths)
+    handles = {}
+    while remaining:
+        path = rand.choice(remaining.keys())
+        if path not in handles:
+            if len(handles) > 500:
+                for handle in handles.values():
+                    handle.close()
+                handles.clear()
+            handles[path] = open(path, 'ab')
+        handles[path].write(compressible_chunk(rand, words, 65536))
+        # Force allocation now, rather than letting delayed allocation
+        # put each file's blocks back together.
+        handles[path].flush()
+        os.fsync(handles[path].fileno())
+        remaining[path] -= 1
+        if not remaining[path]:
+            del remaining[path]
+            handles.pop(path).close()
+    for handle in handles.values():
+        handle.close()
+
+def compressible_chunk(rand, words, size):
+    """size bytes of words picked at random, separated by spaces."""
+    chunk = ' '.join(rand.choice(words) for _ in range(size // 5))
+    return (chunk * 2)[:size]
+
+def bench_backup(workdir, source, with_prefetch, options):
+    """Make a full backup of source and return how long it took."""
+    target = tempfile.mkdtemp(dir=workdir)
+    specfile = os.path.join(workdir, 'bench.ini')
+    with open(specfile, 'w') as specf:
+        specf.write(CONFIG_TEMPLATE % {'source': source, 'target': target,
+                                       'compression_level': options.compression_level})
+    run_options = argparse.Namespace(specfile=specfile, log_level='WARNING', noop=False)
+    conf = backup_conf.BackupConf(run_options)
+    backup = backup_operation.BackupCopy(run_options, conf, backup_source_root=source)
+    started = time.time()
+    prefetcher = None
+    if with_prefetch:
+        prefetcher = prefetch.Prefetcher(
+                root=source,
+                rules=backup.get_exclusion_rules(),
+                since=None,
+                subdirs=[],
+                window_bytes=options.window_mb * 1024 * 1024,
+                min_available_bytes=256 * 1024 * 1024,
+                logger=logging.getLogger(__name__),
+        )
+        prefetcher.start()
+    try:
+        backup.run()
+    finally:
+        if prefetcher is not None:
+            prefetcher.stop()
+    seconds = time.time() - started
+    shutil.rmtree(target)
+    return seconds
+
+def report(results):
+    without = sum(results[False]) / len(results[False])
+    with_prefetch = sum(results[True]) / len(results[True])
+    print('%-16s %10s' % ('', 'mean s'))
+    print('%-16s %10.2f' % ('without', without))
+    print('%-16s %10.2f' % ('with prefetch', with_prefetch))
+    print('speedup %.2fx' % (without / with_prefetch))
+
+def get_options():
+    """Get options for the script."""
+    parser = argparse.ArgumentParser(
+               description="benchmark backups with and without the prefetcher",
+             )
+    parser.add_argument('--size-mb', type=int, default=2048,
+            help='size of the ext4 image in MB; files fill 70%% of it.  Default: 2048')
+    parser.add_argument('--files', type=int, default=2000,
+            help='number of files in the image.  Default: 2000')
+    parser.add_argument('--window-mb', type=int, default=512,
+            help='prefetch window in MB.  Default: 512')
+    parser.add_argument('--compression-level', type=int, default=0,
+            help='gzip level for dar, as [backup]compression_level.  Default: 0, '
+                 'so the disk rather than the CPU is measured')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='number of runs each way.  Default: 3')
+    parser.add_argument('--workdir', default=None,
+            help='where to make the image.  Default: system temp dir')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main(get_options())
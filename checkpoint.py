@@ -0,0 +1,198 @@
+#! /usr/bin/env python
+
+"""Split backups into work units, and keep a journal of those done so a
+failed backup can be resumed.
+"""
+
+import datetime
+import errno
+import json
+import os
+import os.path
+import threading
+
+JOURNAL_FILENAME = 'checkpoint_journal'
+UNITS_FILENAME = 'work_units'
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def part_key(part_name):
+    """The key a part's units are kept under: its name, or '' for the
+    main volume.
+    """
+    return part_name or ''
+
+def _is_under(path, directory):
+    return path == directory or path.startswith(directory + '/')
+
+def _save_json(filename, data):
+    """Replace the file with the data as JSON, making sure it's on disk
+    before returning.
+    """
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as jsonf:
+        json.dump(data, jsonf, indent=1, sort_keys=True)
+        jsonf.flush()
+        os.fsync(jsonf.fileno())
+    os.rename(temp_filename, filename)
+    dir_fd = os.open(os.path.dirname(filename) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def _utf8(value):
+    """json gives back unicode; paths and names are byte strings here."""
+    return value.encode('utf-8')
+
+def _load_json(filename):
+    """Return the data in a JSON file, or None if it doesn't exist."""
+    try:
+        with open(filename) as jsonf:
+            return json.load(jsonf)
+    except IOError, exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise
+
+
+class WorkUnits(object):
+    """How each part of the backups in a set is split into work units.
+
+    Decided when the set's full backup is taken, and kept in the
+    work_units file in the set, so each unit of an incremental has the
+    same unit of its parent to compare against.
+
+    Unit u0 of a part holds whatever isn't in any other unit, including
+    anything new since the split was decided.  Units u1 and on each hold
+    some of the directories (or files) at the top of the part.
+    """
+    def __init__(self, units=None):
+        """
+        units: A dict of part keys (the part's name, or '' for the main
+               volume) to lists, one per unit from u1, of the paths in it.
+        """
+        self.units = dict(units or {})
+
+    @classmethod
+    def load(cls, set_root):
+        """Return the WorkUnits saved in the set, or None if there aren't any.
+        """
+        data = _load_json(os.path.join(set_root, UNITS_FILENAME))
+        if data is None:
+            return None
+        return cls(dict((_utf8(key), [[_utf8(path) for path in unit] for unit in units])
+                        for (key, units) in data.items()))
+
+    def save(self, set_root):
+        _save_json(os.path.join(set_root, UNITS_FILENAME), self.units)
+
+    @classmethod
+    def balanced(cls, sizes, count):
+        """Split paths into at most count units of about the same size.
+
+        sizes: A dict of part keys to dicts of paths to their sizes in bytes.
+        """
+        units = {}
+        for part_key, part_sizes in sizes.items():
+            bins = [[0, []] for _ in range(count)]
+            # Biggest first, each into the emptiest unit so far.
+            for path in sorted(part_sizes, key=lambda path: (-part_sizes[path], path)):
+                emptiest = min(bins, key=lambda unit: unit[0])
+                emptiest[0] += part_sizes[path]
+                emptiest[1].append(path)
+            units[part_key] = [sorted(paths) for (_, paths) in bins if paths]
+        return cls(units)
+
+    def unit_names(self, part_key):
+        """The names of the units of a part: u0, u1 and so on."""
+        return ['u%d' % number for number in range(len(self.units.get(part_key, [])) + 1)]
+
+    def unit_paths(self, part_key, unit_name):
+        """The paths in a unit, or all the paths in the other units for u0.
+        """
+        paths = self.units.get(part_key, [])
+        number = int(unit_name[1:])
+        if number == 0:
+            return [path for unit in paths for path in unit]
+        return paths[number - 1]
+
+    def unit_for_path(self, part_key, path):
+        """The name of the unit of the part that would hold path."""
+        for number, paths in enumerate(self.units.get(part_key, [])):
+            for unit_path in paths:
+                if _is_under(path, unit_path):
+                    return 'u%d' % (number + 1)
+        return 'u0'
+
+    def units_under(self, part_key, path):
+        """The names of the units of the part that can hold anything at or
+        under path: u0, and any with a path that's in path or holds it.
+        """
+        names = ['u0']
+        for number, paths in enumerate(self.units.get(part_key, [])):
+            for unit_path in paths:
+                if not path or _is_under(path, unit_path) or _is_under(unit_path, path):
+                    names.append('u%d' % (number + 1))
+                    break
+        return names
+
+
+class Journal(object):
+    """The progress of a backup being made in units, kept in the set so a
+    failed backup can be resumed.
+
+    It records the backup's date (which its archive names are made from),
+    its parent, when it was started, and which units are done.  It's
+    rewritten, and flushed to disk, as each unit is finished.
+    """
+    def __init__(self, set_root, backup_date, parent, started=None, done=None):
+        self.filename = os.path.join(set_root, JOURNAL_FILENAME)
+        self.backup_date = backup_date
+        self.parent = parent
+        self.started = started or datetime.datetime.now()
+        self.done = set(done or [])
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, set_root):
+        """Return the Journal in the set, or None if there isn't one."""
+        data = _load_json(os.path.join(set_root, JOURNAL_FILENAME))
+        if data is None:
+            return None
+        return cls(set_root,
+                   datetime.datetime.strptime(data['backup_date'], TIME_FORMAT),
+                   _utf8(data['parent']),
+                   datetime.datetime.strptime(data['started'], TIME_FORMAT),
+                   [_utf8(key) for key in data['done']])
+
+    def save(self):
+        _save_json(self.filename, {
+            'backup_date': self.backup_date.strftime(TIME_FORMAT),
+            'parent': self.parent,
+            'started': self.started.strftime(TIME_FORMAT),
+            'done': sorted(self.done),
+        })
+
+    def is_done(self, key):
+        return key in self.done
+
+    def set_done(self, key):
+        """Record a unit as done.  Called from the threads running units."""
+        with self._lock:
+            self.done.add(key)
+            self.save()
+
+    def can_resume(self, parent, now, window_hours):
+        """Whether a backup with the given parent, starting now, can carry
+        on from this one.
+        """
+        return (self.parent == parent
+                and now - self.started <= datetime.timedelta(hours=window_hours))
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,177 @@
+#! /usr/bin/env python
+
+"""Estimate how big and how long a backup will be, before running it.
+"""
+
+import os
+import os.path
+import stat
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Number of directories to scan at once
+SCAN_THREADS = 8
+
+# Archive bytes per changed byte to assume when there's no history yet
+DEFAULT_COMPRESSION_RATIO = 0.5
+
+class ChangeScan(object):
+    """Total up the files under a tree, and those changed since a given time.
+
+    The top-level directories are scanned in parallel.  Excluded paths
+    are skipped, as dar would skip them.
+    """
+    def __init__(self, rules, since=None):
+        """
+        rules: The ExclusionRules to apply.
+        since: Seconds since the epoch.  Files whose mtime or ctime is
+               later than this count as changed.  None counts everything
+               as changed, as for a full backup.
+        """
+        self.rules = rules
+        self.since = since
+        self.total_bytes = 0
+        self.total_files = 0
+        self.changed_bytes = 0
+        self.changed_files = 0
+        # Total bytes under each top-level entry scanned
+        self.top_bytes = {}
+
+    def scan(self, root, subdirs=None):
+        """Scan the tree under root, or just the given subdirectories of it.
+        """
+        if subdirs:
+            tops = [subdir.strip('/') for subdir in subdirs]
+        else:
+            tops = os.listdir(root)
+        pool = ThreadPool(SCAN_THREADS)
+        try:
+            results = pool.map(lambda relpath: self._scan_top(root, relpath), tops)
+        finally:
+            pool.close()
+            pool.join()
+        for relpath, counts in zip(tops, results):
+            self.top_bytes[relpath] = counts[1]
+            self.total_files += counts[0]
+            self.total_bytes += counts[1]
+            self.changed_files += counts[2]
+            self.changed_bytes += counts[3]
+        return self
+
+    def _scan_top(self, root, relpath):
+        """Scan one top-level entry.  Runs in a worker thread, so only
+        returns its counts: [total files, total bytes, changed files, changed bytes]
+        """
+        counts = [0, 0, 0, 0]
+        fullpath = os.path.join(root, relpath)
+        try:
+            st = os.lstat(fullpath)
+        except OSError:
+            return counts
+        if stat.S_ISDIR(st.st_mode):
+            if not self.rules.excludes(relpath, True, fullpath):
+                self._scan_dir(fullpath, relpath, counts)
+        elif not self.rules.excludes(relpath):
+            self._count(st, counts)
+        return counts
+
+    def _scan_dir(self, fullpath, relpath, counts):
+        for name, child_full, is_dir, st in dir_entries(fullpath):
+            child_rel = os.path.join(relpath, name)
+            if self.rules.excludes(child_rel, is_dir, child_full):
+                continue
+            if is_dir:
+                self._scan_dir(child_full, child_rel, counts)
+            elif st is not None:
+                self._count(st, counts)
+
+    def _count(self, st, counts):
+        counts[0] += 1
+        counts[1] += st.st_size
+        if self.since is None or max(st.st_mtime, st.st_ctime) > self.since:
+            counts[2] += 1
+            counts[3] += st.st_size
+
+
+def dir_entries(path):
+    """Yield (name, full path, is directory, lstat result) for each entry
+    in a directory, using scandir when it's available.
+    """
+    if scandir is not None:
+        try:
+            iterator = scandir(path)
+        except OSError:
+            return
+        for entry in iterator:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                st = None if is_dir else entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            yield entry.name, entry.path, is_dir, st
+    else:
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        for name in names:
+            child = os.path.join(path, name)
+            try:
+                st = os.lstat(child)
+            except OSError:
+                continue
+            yield name, child, stat.S_ISDIR(st.st_mode), st
+
+
+class Estimate(object):
+    """Predictions for a backup, from a ChangeScan and the RunHistory.
+    """
+    def __init__(self, scan, history, kind, slice_size, target_dir):
+        """
+        scan: A ChangeScan that has been run.
+        history: The RunHistory for the profile.
+        kind: 'full' or 'incremental'.
+        slice_size: The dar slice size in bytes.
+        target_dir: Where the archive will be written.
+        """
+        self.scan = scan
+        self.kind = kind
+        ratio = history.compression_ratio(kind) or history.compression_ratio()
+        self.ratio_from_history = ratio is not None
+        self.ratio = ratio if ratio is not None else DEFAULT_COMPRESSION_RATIO
+        self.throughput = history.throughput(kind) or history.throughput()
+        self.slice_size = slice_size
+        self.target_free = _free_bytes(target_dir)
+
+    def archive_bytes(self):
+        return int(self.scan.changed_bytes * self.ratio)
+
+    def slices(self):
+        return max(1, (self.archive_bytes() + self.slice_size - 1) // self.slice_size)
+
+    def seconds(self):
+        """Predicted duration, or None if there's no history to go on."""
+        if not self.throughput:
+            return None
+        return self.scan.changed_bytes / self.throughput
+
+    def fits(self):
+        return self.archive_bytes() < self.target_free
+
+
+def _free_bytes(path):
+    """Bytes available to unprivileged users on the filesystem holding path."""
+    vfs = os.statvfs(path)
+    return vfs.f_bavail * vfs.f_frsize
+
+
+def format_seconds(seconds):
+    """Format a duration as H:MM:SS"""
+    seconds = int(round(seconds))
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+
+"""Decide which files to leave out of the backup, and report on the effect.
+"""
+
+import os
+import os.path
+import re
+import stat
+import fnmatch
+
+# Built-in sets of paths that can be regenerated, so aren't worth backing up.
+# Paths are relative to the root of the backup, and may contain wildcards.
+# Names only match files, as dar's -X never applies to directories, so
+# directories to leave out wherever they are go in paths as */name.
+PROFILES = {
+    'common': {
+        'paths': [
+            'tmp',
+            'var/tmp',
+            'var/cache/apt/archives',
+            'var/cache/yum',
+            'var/cache/dnf',
+            'var/cache/pacman/pkg',
+            'root/.cache',
+            'home/*/.cache',
+            'home/*/.thumbnails',
+            'home/*/.local/share/Trash',
+            'home/*/.mozilla/firefox/*/cache2',
+            'home/*/.ccache',
+            'home/*/.npm/_cacache',
+            'home/*/.cargo/registry',
+            '*/__pycache__',
+            ],
+        'names': [
+            '*.pyc',
+            '*.o',
+            ],
+        },
+    }
+
+CACHEDIR_TAG = 'CACHEDIR.TAG'
+CACHEDIR_TAG_SIGNATURE = 'Signature: 8a477f597d28d172789f06886806bc55'
+
+class ExclusionRules(object):
+    """The exclusions configured in the [exclude] section, combined with
+    those of any built-in profiles selected there.
+
+    The same rules are turned into dar arguments by dar_args(), and
+    applied in Python by excludes() for reporting.
+    """
+    def __init__(self, config):
+        """
+        config: The BackupConf object for the current instance.
+        """
+        self.paths = list(config.exclude_paths())
+        self.names = list(config.exclude_names())
+        self.regexes = list(config.exclude_regexes())
+        self.cachedir_tag = config.exclude_cachedir_tag()
+        for profile in config.exclude_profiles():
+            try:
+                self.paths.extend(PROFILES[profile]['paths'])
+                self.names.extend(PROFILES[profile]['names'])
+            except KeyError:
+                raise ValueError('Unknown exclusion profile: %s' % profile)
+        self._compiled_regexes = [re.compile(regex) for regex in self.regexes]
+
+    def dar_args(self):
+        """Return the list of arguments to add to a dar command line to
+        apply these exclusions.
+        """
+        args = []
+        for path in self.paths:
+            args.extend(['-P', path])
+        for name in self.names:
+            args.extend(['-X', name])
+        if self.regexes:
+            # -ar switches the following masks to regular expressions,
+            # -ag switches back to the default of glob patterns.
+            args.append('-ar')
+            for regex in self.regexes:
+                args.extend(['-P', regex])
+            args.append('-ag')
+        if self.cachedir_tag:
+            args.append('--cache-directory-tagging')
+        return args
+
+    def excludes(self, relpath, is_dir=False, fullpath=None):
+        """Return True if the file or directory at relpath (relative to the
+        root of the backup) should be left out.
+
+        fullpath: where the entry actually is, needed to look for a
+                  CACHEDIR.TAG in directories.
+        """
+        for pattern in self.paths:
+            if fnmatch.fnmatchcase(relpath, pattern):
+                return True
+        if not is_dir:
+            # Like dar's -X, names never match directories.
+            name = os.path.basename(relpath)
+            for pattern in self.names:
+                if fnmatch.fnmatchcase(name, pattern):
+                    return True
+        for regex in self._compiled_regexes:
+            if regex.search(relpath):
+                return True
+        if self.cachedir_tag and is_dir and fullpath is not None:
+            return is_cache_dir(fullpath)
+        return False
+
+
+def is_cache_dir(path):
+    """Return True if the directory has a CACHEDIR.TAG file with the right
+    signature, as per http://www.brynosaurus.com/cachedir/
+    """
+    try:
+        with open(os.path.join(path, CACHEDIR_TAG)) as tagf:
+            return tagf.read(len(CACHEDIR_TAG_SIGNATURE)) == CACHEDIR_TAG_SIGNATURE
+    except IOError:
+        return False
+
+
+def escape_glob(path):
+    """Return a dar -P or -g mask matching just the path, with any
+    wildcard characters in it made literal.
+    """
+    # A backslash is doubled in its brackets, as it may escape a bracket.
+    return re.sub(r'[*?[]', r'[\g<0>]', path).replace('\\', '[\\\\]')
+
+
+class ExclusionReport(object):
+    """Walk a directory tree and total up what the rules would include
+    and exclude.
+
+    After calling walk(), excluded holds (bytes, relpath) for the top of
+    each excluded subtree, and included holds (bytes, relpath) of included
+    bytes for each directory down to max_depth.
+    """
+    def __init__(self, rules, max_depth=2):
+        self.rules = rules
+        self.max_depth = max_depth
+        self.excluded = []
+        self.included = []
+
+    def walk(self, root, subdirs=None):
+        """Walk the tree under root, or just the given subdirectories of it.
+
+        Returns the total number of bytes that would be included.
+        """
+        total = 0
+        for subdir in (subdirs or ['']):
+            total += self._walk_dir(root, subdir.strip('/'))
+        return total
+
+    def _walk_dir(self, root, relpath):
+        """Return the bytes included under relpath, recording subtrees as
+        it goes.
+        """
+        fullpath = os.path.join(root, relpath)
+        included = 0
+        try:
+            names = os.listdir(fullpath)
+        except OSError:
+            return 0
+        for name in names:
+            child_rel = os.path.join(relpath, name)
+            child_full = os.path.join(fullpath, name)
+            try:
+                st = os.lstat(child_full)
+            except OSError:
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if self.rules.excludes(child_rel, is_dir, child_full):
+                size = _tree_size(child_full) if is_dir else st.st_size
+                self.excluded.append((size, child_rel))
+            elif is_dir:
+                included += self._walk_dir(root, child_rel)
+            else:
+                included += st.st_size
+        if relpath and relpath.count('/') < self.max_depth:
+            self.included.append((included, relpath))
+        return included
+
+    def largest_excluded(self, count):
+        return sorted(self.excluded, reverse=True)[:count]
+
+    def largest_included(self, count):
+        return sorted(self.included, reverse=True)[:count]
+
+    def excluded_total(self):
+        return sum(size for (size, _) in self.excluded)
+
+
+def _tree_size(path):
+    """Total size of the regular files under path, not following symlinks."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def human_size(num_bytes):
+    """Format a byte count for people, e.g. 1536 -> '1.5K'"""
+    size = float(num_bytes)
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+    if unit == '':
+        return '%d' % num_bytes
+    return '%.1f%s' % (size, unit)
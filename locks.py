@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+
+"""Stop backups of the same profile overlapping, and limit how many run
+against one target at once.
+"""
+
+import errno
+import fcntl
+import os
+import os.path
+
+# In each profile's backup target
+LOCK_FILENAME = 'backup.lock'
+
+# Slot files are named SLOT_PREFIX + number in the slots directory
+SLOT_PREFIX = '.backup-slot.'
+
+# Exit status of the backup script when the profile is already being
+# backed up (EX_TEMPFAIL from sysexits.h)
+EXIT_ALREADY_RUNNING = 75
+
+class AlreadyRunning(Exception):
+    pass
+
+class NoSlotFree(AlreadyRunning):
+    pass
+
+class ProfileLock(object):
+    """An exclusive flock() on the lock file in a profile's backup target,
+    held for the whole of a backup run, cleanup from last time included.
+
+    The kernel drops the lock if the process dies, so there's no stale
+    lock to clear up after a crash.
+    """
+    def __init__(self, backup_root):
+        self.filename = os.path.join(backup_root, LOCK_FILENAME)
+        self._fd = None
+
+    def acquire(self):
+        """Take the lock, or raise AlreadyRunning if another process has it.
+        """
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, exc:
+            os.close(fd)
+            if exc.errno in (errno.EAGAIN, errno.EACCES):
+                raise AlreadyRunning('%s is locked by another backup' % self.filename)
+            raise
+        # Leave our pid in the file, for whoever finds it locked.
+        os.ftruncate(fd, 0)
+        os.write(fd, '%d\n' % os.getpid())
+        self._fd = fd
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class TargetSlots(object):
+    """A fixed number of tokens for running backups against one target,
+    such as a shared NFS server, each a lockf() lock on a slot file in a
+    directory there.
+
+    POSIX locks go through the NFS lock manager, so the limit holds across
+    every host using the same directory.  They belong to the process that
+    took them and aren't inherited by its children, so a slot is taken by
+    the backup process itself, and freed when it exits however it exits.
+    """
+    def __init__(self, directory, slots):
+        self.directory = directory
+        self.slots = slots
+
+    def acquire(self):
+        """Take a free slot and return it, or None if they're all in use.
+        """
+        for number in range(1, self.slots + 1):
+            slot = TargetSlot(os.path.join(self.directory, '%s%d' % (SLOT_PREFIX, number)))
+            if slot.try_acquire():
+                return slot
+        return None
+
+    def any_free(self):
+        """Return True if a slot could be taken now, without keeping it.
+        """
+        slot = self.acquire()
+        if slot is None:
+            return False
+        slot.release()
+        return True
+
+
+class TargetSlot(object):
+    """One slot of a TargetSlots.  Call release() when the backup's done.
+
+    POSIX locks don't conflict within a process, and closing any
+    descriptor for the file drops them, so the slots this process holds
+    are also kept track of here and never reopened while held.
+    """
+    _held = set()
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+
+    def try_acquire(self):
+        if self.filename in self._held:
+            return False
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, exc:
+            os.close(fd)
+            if exc.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._fd = fd
+        self._held.add(self.filename)
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._held.discard(self.filename)
+
+    def __repr__(self):
+        return 'TargetSlot(%r)' % self.filename
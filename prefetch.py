@@ -0,0 +1,317 @@
+#! /usr/bin/env python
+
+"""Read the files a backup is about to archive into the page cache, in the
+order they lie on disk, a little ahead of the backup itself.
+"""
+
+import estimator
+import array
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import os.path
+import stat
+import struct
+import threading
+import time
+
+# ioctl to map a file's extents, from linux/fs.h
+FS_IOC_FIEMAP = 0xC020660B
+
+# fe_flags: this is the file's last extent, or its blocks have no fixed
+# place on disk yet (delayed allocation, inline data and so on)
+FIEMAP_EXTENT_LAST = 0x001
+FIEMAP_EXTENT_UNKNOWN = 0x002
+
+# struct fiemap and struct fiemap_extent, from linux/fiemap.h
+_FIEMAP = struct.Struct('=QQIIII')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+
+# How many extents to ask for at a time
+EXTENTS_PER_CALL = 64
+
+# Extents are read ahead in pieces of at most this many bytes
+PIECE_BYTES = 8 * 1024 * 1024
+
+# How often to check how far ahead of the backup the prefetch is, in seconds
+PACE_SECONDS = 0.2
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _readahead = _libc.readahead
+    _readahead.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_size_t]
+    _readahead.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    _readahead = None
+
+def available():
+    """Return True if readahead(2) can be called on this system."""
+    return _readahead is not None
+
+class Prefetcher(object):
+    """Prefetch a tree in a background thread while it's backed up.
+
+    The files are taken in the order dar visits them: depth first, in
+    directory order, leaving out whatever it leaves out and, for an
+    incremental, files that haven't changed.  They're gathered into
+    batches of up to half the window, and each batch is read ahead in
+    physical block order, using the extents FIEMAP gives.
+
+    The prefetch stays no more than window_bytes ahead of what the
+    backup's processes have read (the rchar in /proc/<pid>/io of this
+    process's descendants), and pauses whenever MemAvailable drops below
+    min_available_bytes, so it doesn't evict pages the backup still needs.
+    """
+    def __init__(self, root, rules, since, subdirs, window_bytes,
+                 min_available_bytes, logger, skip=()):
+        """
+        root: The root of the tree being backed up.
+        rules: The ExclusionRules dar is given.
+        since: Seconds since the epoch; only files changed after this are
+               read ahead.  None for all of them, as for a full backup.
+        subdirs: The subdirectories being backed up, or [] for all.
+        skip: Paths relative to root that won't be read, such as those in
+              the work units a resumed backup has already archived.
+        """
+        self.root = root
+        self.rules = rules
+        self.since = since
+        self.subdirs = subdirs
+        self.skip = set(skip)
+        self.window_bytes = window_bytes
+        self.min_available_bytes = min_available_bytes
+        self.log = logger
+        self.prefetched_bytes = 0
+        self.prefetched_files = 0
+        self.paused_seconds = 0.0
+        self._consumed = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop prefetching and wait for the thread to finish."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.log.info('Prefetched %d files, %d bytes; paused %.1fs for the backup to catch up',
+                      self.prefetched_files, self.prefetched_bytes, self.paused_seconds)
+
+    def _run(self):
+        # Prefetching only ever makes the backup faster or slower, so a
+        # failure here mustn't fail the backup.
+        try:
+            for batch in self._batches():
+                if not self._wait_for_room(sum(piece[3] for piece in batch)):
+                    return
+                self._read_ahead(batch)
+        except Exception, exc:
+            self.log.warn('Prefetch stopped: %s', exc)
+
+    def _batches(self):
+        """Yield lists of (physical, path, logical, length) pieces, each
+        sorted into physical order.
+        """
+        batch_limit = max(PIECE_BYTES, self.window_bytes // 2)
+        batch = []
+        batch_bytes = 0
+        for path, size in self._files():
+            if self._stop.is_set():
+                return
+            self.prefetched_files += 1
+            for piece in _pieces(path, size):
+                batch.append(piece)
+                batch_bytes += piece[3]
+                if batch_bytes >= batch_limit:
+                    yield sorted(batch)
+                    batch = []
+                    batch_bytes = 0
+        if batch:
+            yield sorted(batch)
+
+    def _files(self):
+        """Yield (path, size) for each file dar will read the data of."""
+        if self.subdirs:
+            tops = [subdir.strip('/') for subdir in self.subdirs]
+        else:
+            tops = [name for name, _, _, _ in estimator.dir_entries(self.root)]
+        for relpath in tops:
+            if self._skipped(relpath):
+                continue
+            fullpath = os.path.join(self.root, relpath)
+            try:
+                st = os.lstat(fullpath)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if not self.rules.excludes(relpath, True, fullpath):
+                    for found in self._dir_files(fullpath, relpath):
+                        yield found
+            elif self._wanted(relpath, False, fullpath, st):
+                yield fullpath, st.st_size
+
+    def _dir_files(self, fullpath, relpath):
+        for name, child_full, is_dir, st in estimator.dir_entries(fullpath):
+            child_rel = os.path.join(relpath, name)
+            if child_rel in self.skip:
+                continue
+            if is_dir:
+                if not self.rules.excludes(child_rel, True, child_full):
+                    for found in self._dir_files(child_full, child_rel):
+                        yield found
+            elif self._wanted(child_rel, False, child_full, st):
+                yield child_full, st.st_size
+
+    def _skipped(self, relpath):
+        """Whether relpath is, or is under, one of the paths to skip."""
+        return any(relpath == path or relpath.startswith(path + '/') for path in self.skip)
+
+    def _wanted(self, relpath, is_dir, fullpath, st):
+        if st is None or not stat.S_ISREG(st.st_mode) or not st.st_size:
+            return False
+        if self.since is not None and max(st.st_mtime, st.st_ctime) <= self.since:
+            return False
+        return not self.rules.excludes(relpath, is_dir, fullpath)
+
+    def _wait_for_room(self, batch_bytes):
+        """Wait until the batch can be read ahead without getting more than
+        the window ahead of the backup, or running short of memory.
+
+        Returns False if told to stop while waiting.
+        """
+        started = time.time()
+        try:
+            while not self._stop.is_set():
+                free = mem_available()
+                if free is None or free >= self.min_available_bytes:
+                    ahead = self.prefetched_bytes - self._consumed_bytes()
+                    if ahead <= 0 or ahead + batch_bytes <= self.window_bytes:
+                        return True
+                self._stop.wait(PACE_SECONDS)
+            return False
+        finally:
+            self.paused_seconds += time.time() - started
+
+    def _consumed_bytes(self):
+        """How many bytes the backup's processes have read, including any
+        that have since exited.
+        """
+        for pid, rchar in _descendant_rchar(os.getpid()).items():
+            self._consumed[pid] = max(rchar, self._consumed.get(pid, 0))
+        return sum(self._consumed.values())
+
+    def _read_ahead(self, batch):
+        for physical, path, logical, length in batch:
+            if self._stop.is_set():
+                return
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                if _readahead(fd, logical, length) < 0:
+                    self.log.debug('readahead %r: %s', path, os.strerror(ctypes.get_errno()))
+            finally:
+                os.close(fd)
+            self.prefetched_bytes += length
+
+
+def _pieces(path, size):
+    """Return the (physical, path, logical, length) pieces of a file, each
+    no bigger than PIECE_BYTES.
+
+    Where the extents can't be mapped, the whole file is one piece at
+    physical offset 0.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return []
+    try:
+        extents = file_extents(fd, size)
+    except IOError, exc:
+        if exc.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+            raise
+        extents = []
+    finally:
+        os.close(fd)
+    if not extents:
+        extents = [(0, 0, size)]
+    pieces = []
+    for physical, logical, length in extents:
+        for offset in range(0, length, PIECE_BYTES):
+            pieces.append((physical + offset, path, logical + offset,
+                           min(PIECE_BYTES, length - offset)))
+    return pieces
+
+def file_extents(fd, size):
+    """Return (physical, logical, length) for each extent of the open file,
+    in bytes, using the FIEMAP ioctl.
+
+    Extents without a fixed place on disk are given physical offset 0.
+    """
+    extents = []
+    start = 0
+    while start < size:
+        request = _FIEMAP.pack(start, size - start, 0, 0, EXTENTS_PER_CALL, 0)
+        buf = array.array('B', request + '\0' * (_FIEMAP_EXTENT.size * EXTENTS_PER_CALL))
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf, True)
+        raw = buf.tostring()
+        mapped = _FIEMAP.unpack_from(raw)[3]
+        if not mapped:
+            break
+        for number in range(mapped):
+            fields = _FIEMAP_EXTENT.unpack_from(raw, _FIEMAP.size + number * _FIEMAP_EXTENT.size)
+            logical, physical, length, flags = fields[0], fields[1], fields[2], fields[5]
+            if flags & FIEMAP_EXTENT_UNKNOWN:
+                physical = 0
+            extents.append((physical, logical, length))
+        if flags & FIEMAP_EXTENT_LAST:
+            break
+        start = logical + length
+    return extents
+
+def mem_available():
+    """MemAvailable from /proc/meminfo, in bytes, or None if it isn't there."""
+    try:
+        with open('/proc/meminfo') as memf:
+            for line in memf:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+    return None
+
+def _descendant_rchar(pid):
+    """Return {pid: rchar} for every descendant of the given process."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join('/proc', entry, 'stat')) as statf:
+                # The command name is in brackets and may contain spaces.
+                fields = statf.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    rchar = {}
+    waiting = list(children.get(pid, []))
+    while waiting:
+        child = waiting.pop()
+        waiting.extend(children.get(child, []))
+        try:
+            with open(os.path.join('/proc', str(child), 'io')) as iof:
+                for line in iof:
+                    if line.startswith('rchar:'):
+                        rchar[child] = int(line.split()[1])
+        except IOError:
+            continue
+    return rchar
@@ -4,6 +4,11 @@
 
 import subprocess
 import logging
+import threading
+import time
+
+# How often to look whether a command whose reads are counted has exited
+EXIT_POLL_SECONDS = 0.2
 
 class LoggableCalls(object):
     """Log command line calls to a logger, report exit status if they fail.
@@ -15,6 +20,9 @@ class LoggableCalls(object):
         self.log = logger
         self.noop = noop
         self.internal_log = logging.getLogger(__name__)
+        # Bytes read by the commands run with check_call_counting_reads()
+        self.bytes_read = 0
+        self._lock = threading.Lock()
 
     def check_call(self, cmd_args):
         """Log and optionally run
@@ -47,3 +55,54 @@ class LoggableCalls(object):
             self.internal_log.debug('CalledProcessError caught')
             self.log.error(str(exc))
             raise exc
+
+    def check_call_counting_reads(self, cmd_args):
+        """Log and optionally run, like check_call(), adding how many bytes
+        the command read (its rchar) to bytes_read, whether it succeeds or
+        not.
+        """
+        self.log_cmd(cmd_args)
+        if self.noop:
+            self.internal_log.debug('noop set, not running command for real')
+            return
+        self.internal_log.debug('running command for real...')
+        proc = subprocess.Popen(cmd_args)
+        # Commands may be running in several threads at once, so only the
+        # total is locked, not the wait.
+        rchar = _wait_for_exit_and_rchar(proc)
+        with self._lock:
+            self.bytes_read += rchar
+        if proc.returncode:
+            exc = subprocess.CalledProcessError(proc.returncode, cmd_args)
+            self.log.error(str(exc))
+            raise exc
+
+
+def _wait_for_exit_and_rchar(proc):
+    """Wait for the process to exit and return its rchar, the bytes it
+    read, or 0 if /proc doesn't say.
+
+    /proc/<pid>/io is read after the process has exited but before it's
+    reaped, so it has the final count.
+    """
+    stat_filename = '/proc/%d/stat' % proc.pid
+    while proc.returncode is None:
+        try:
+            with open(stat_filename) as statf:
+                # The command name is in brackets and may contain spaces.
+                state = statf.read().rsplit(')', 1)[1].split()[0]
+        except (IOError, IndexError):
+            break
+        if state in ('Z', 'X'):
+            break
+        time.sleep(EXIT_POLL_SECONDS)
+    rchar = 0
+    try:
+        with open('/proc/%d/io' % proc.pid) as iof:
+            for line in iof:
+                if line.startswith('rchar:'):
+                    rchar = int(line.split()[1])
+    except IOError:
+        pass
+    proc.wait()
+    return rchar
@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+
+"""Quiesce applications for as short a time as possible around the
+snapshots.
+"""
+
+import errno
+import os
+import select
+import shlex
+import subprocess
+import threading
+import time
+
+# Warn if any application is kept quiesced for longer than this
+WARN_WINDOW_MS = 1000
+
+class QuiesceFailed(Exception):
+    pass
+
+class Quiescer(object):
+    """Run the quiesce hooks all at once, then release them all at once.
+
+    Use like:
+
+        quiescer = Quiescer(conf.quiesce_hooks(), log)
+        quiescer.quiesce()
+        try:
+            # make the snapshots
+        finally:
+            quiescer.release()
+    """
+    def __init__(self, hooks, logger, noop=False):
+        """
+        hooks: A list of backup_conf.QuiesceHook.
+        """
+        self.log = logger
+        self.noop = noop
+        self.runs = [HookRun(hook, logger) for hook in hooks]
+
+    def quiesce(self):
+        """Quiesce every application, returning when they all are.
+
+        If any required hook fails, they're all released again, the
+        failed ones included, and QuiesceFailed is raised.  Other failures are logged as warnings.
+        """
+        if not self.runs:
+            return
+        if self.noop:
+            for run in self.runs:
+                self.log.info('Quiesce %s: %r %r', run.hook.name, run.hook.hold, run.hook.quiesce)
+            return
+        self.log.info('Quiescing %s', ', '.join(run.hook.name for run in self.runs))
+        failures = _in_parallel(self.runs, lambda run: run.start())
+        required = [(run, exc) for (run, exc) in failures if run.hook.required]
+        for run, exc in failures:
+            self.log.warn('Couldn\'t quiesce %s: %s', run.hook.name, exc)
+        if required:
+            self.release()
+            raise required[0][1]
+
+    def release(self):
+        """Thaw every application that quiescing was started for, even
+        those it failed for, as they may be part quiesced, and report how
+        long each was quiesced for.  Failures are logged, not raised, as
+        the snapshots are good by now.
+        """
+        if self.noop:
+            for run in self.runs:
+                if run.hook.thaw is not None:
+                    self.log.info('Thaw %s: %r', run.hook.name, run.hook.thaw)
+            return
+        started = [run for run in self.runs if run.started_at is not None]
+        if not started:
+            return
+        failures = _in_parallel(started, lambda run: run.finish())
+        for run, exc in failures:
+            self.log.error('Couldn\'t thaw %s: %s', run.hook.name, exc)
+        for run in started:
+            if run.quiesced_at is None:
+                self.log.info('%s thawed %d ms after failing to quiesce (%d ms to thaw)',
+                              run.hook.name, run.window_ms(), run.thaw_ms())
+            else:
+                self.log.info('%s quiesced for %d ms (%d ms to quiesce, %d ms to thaw)',
+                              run.hook.name, run.window_ms(), run.quiesce_ms(), run.thaw_ms())
+        longest = max(started, key=lambda run: run.window_ms())
+        if longest.window_ms() > WARN_WINDOW_MS:
+            self.log.warn('%s was quiesced for %d ms', longest.hook.name, longest.window_ms())
+        print('Applications quiesced for %d ms' % longest.window_ms())
+
+
+class HookRun(object):
+    """Quiescing and thawing one application.
+
+    The window is timed from starting to quiesce it until it's thawed.
+    """
+    def __init__(self, hook, logger):
+        self.hook = hook
+        self.log = logger
+        self._holder = None
+        self.started_at = None
+        self.quiesced_at = None
+        self.thaw_started_at = None
+        self.thawed_at = None
+
+    def start(self):
+        """Quiesce the application, or raise QuiesceFailed."""
+        self.started_at = time.time()
+        try:
+            if self.hook.hold is not None:
+                self._start_holder()
+            if self.hook.quiesce is not None:
+                self.log.info('Command: %r', self.hook.quiesce)
+                _run(self.hook.quiesce, self.hook.timeout - (time.time() - self.started_at))
+        except Exception:
+            self._stop_holder()
+            raise
+        self.quiesced_at = time.time()
+
+    def finish(self):
+        """Thaw the application, or raise QuiesceFailed.  The hold command,
+        if any, is stopped even if thaw fails.
+
+        Also called if quiescing failed, in case it got part way.
+        """
+        self.thaw_started_at = time.time()
+        try:
+            if self.hook.thaw is not None:
+                self.log.info('Command: %r', self.hook.thaw)
+                _run(self.hook.thaw, self.hook.thaw_timeout)
+        finally:
+            try:
+                self._stop_holder()
+            finally:
+                self.thawed_at = time.time()
+
+    def _start_holder(self):
+        """Start the hold command and wait for its line saying it's holding
+        the application quiesced.
+        """
+        self.log.info('Command: %r', self.hook.hold)
+        self._holder = subprocess.Popen(shlex.split(self.hook.hold), stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, close_fds=True)
+        fd = self._holder.stdout.fileno()
+        deadline = self.started_at + self.hook.timeout
+        received = ''
+        while '\n' not in received:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise QuiesceFailed('%r not ready within %gs' % (self.hook.hold, self.hook.timeout))
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if readable:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    raise QuiesceFailed('%r exited without saying it was ready' % self.hook.hold)
+                received += chunk
+
+    def _stop_holder(self):
+        """Close the hold command's stdin and wait for it to exit, killing
+        it if it takes longer than thaw_timeout.
+        """
+        if self._holder is None:
+            return
+        holder, self._holder = self._holder, None
+        try:
+            holder.stdin.close()
+        except IOError, exc:
+            if exc.errno != errno.EPIPE:
+                raise
+        if not _wait(holder, self.hook.thaw_timeout):
+            _kill(holder)
+            raise QuiesceFailed('%r still holding after %gs, killed' % (
+                    self.hook.hold, self.hook.thaw_timeout))
+
+    def window_ms(self):
+        return int((self.thawed_at - self.started_at) * 1000)
+
+    def quiesce_ms(self):
+        return int((self.quiesced_at - self.started_at) * 1000)
+
+    def thaw_ms(self):
+        return int((self.thawed_at - self.thaw_started_at) * 1000)
+
+
+def _in_parallel(runs, function):
+    """Call function(run) for each run in its own thread, and return
+    (run, exception) for each that raised one.
+    """
+    failures = []
+    def call(run):
+        try:
+            function(run)
+        except Exception, exc:
+            failures.append((run, exc))
+    threads = [threading.Thread(target=call, args=(run,)) for run in runs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failures
+
+def _run(command, timeout):
+    """Run the command, raising QuiesceFailed if it fails or is still
+    running after timeout seconds, in which case it's killed.
+    """
+    proc = subprocess.Popen(shlex.split(command), close_fds=True)
+    if not _wait(proc, timeout):
+        _kill(proc)
+        raise QuiesceFailed('%r timed out after %.1fs' % (command, timeout))
+    if proc.returncode != 0:
+        raise QuiesceFailed('%r exited with status %d' % (command, proc.returncode))
+
+def _wait(proc, timeout):
+    """Wait up to timeout seconds for the process to exit.  Return True
+    if it did.
+    """
+    deadline = time.time() + timeout
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except OSError:
+        pass
+    proc.wait()
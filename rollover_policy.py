@@ -0,0 +1,183 @@
+#! /usr/bin/env python
+
+"""Decide when to start a new backup set, and so a new full backup.
+"""
+
+import backup_deps
+import datetime
+import errno
+import hashlib
+import os
+import os.path
+
+CURRENT_SET_FILENAME = 'current_set'
+
+def for_config(config):
+    """Return the rollover policy configured for the given BackupConf.
+
+    Without a [rollover] section, a new set is started every month.
+    """
+    if config.rollover_configured():
+        return ChainRollover(config)
+    return MonthlyRollover(config)
+
+
+class MonthlyRollover(object):
+    """Start a new set, named YYYY-MM, on the first backup of each month.
+    """
+    def __init__(self, config):
+        self.conf = config
+
+    def current_set_name(self, backup_date):
+        """Return the name of the set the backup would go into if no new one
+        is started, or None if there isn't one.
+        """
+        return backup_date.strftime('%Y-%m')
+
+    def rollover_reason(self, set_root, backup_date):
+        """Return a string saying why a new set should be started instead
+        of adding to the one in set_root, or None if it shouldn't.
+        """
+        return None
+
+    def new_set_name(self, backup_date):
+        """Return the name to give a new set."""
+        return backup_date.strftime('%Y-%m')
+
+    def synthetic_set_name(self, backup_date):
+        """Return the name of the set to start with a synthetic full made
+        at backup_date.
+
+        This month's set is already under way, so it's next month's.
+        """
+        next_month = (backup_date.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        return self.new_set_name(next_month)
+
+    def remember_set(self, backup_root, set_name):
+        """Record set_name as the current set, if the policy needs to."""
+        pass
+
+
+class ChainRollover(MonthlyRollover):
+    """Start a new set when the chain of backups in the current one reaches
+    any of the limits in the [rollover] section.
+
+    Sets are named after the time they were started (YYYY-MM-DDTHHMM) and
+    the name of the current one is kept in a current_set file in the
+    backup root.
+    """
+    def current_set_name(self, backup_date):
+        """The set named in the current_set file.
+
+        If there isn't one yet, as when moving from monthly sets, carry on
+        with the set holding the newest backup.
+        """
+        backup_root = self.conf.backup_target()
+        try:
+            with open(os.path.join(backup_root, CURRENT_SET_FILENAME)) as currf:
+                name = currf.readline().strip()
+                if name:
+                    return name
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        newest = backup_deps.BackupDeps(backup_root, self.conf.backup_archive_prefix()).newest()
+        if newest is None:
+            return None
+        return newest.set_name
+
+    def new_set_name(self, backup_date):
+        return backup_date.strftime('%Y-%m-%dT%H%M')
+
+    def synthetic_set_name(self, backup_date):
+        """A new set, which becomes the current one straight away."""
+        return self.new_set_name(backup_date)
+
+    def remember_set(self, backup_root, set_name):
+        with open(os.path.join(backup_root, CURRENT_SET_FILENAME), 'w') as currf:
+            currf.write(set_name + '\n')
+
+    def rollover_reason(self, set_root, backup_date):
+        chain = SetChain(set_root, self.conf.backup_archive_prefix())
+        if not chain.archives:
+            # Nothing successful in this set yet, so the next one is its full.
+            return None
+        max_chain = self.conf.rollover_max_chain_length()
+        if max_chain is not None and chain.incremental_count() >= max_chain:
+            return '%d incrementals in chain' % chain.incremental_count()
+        max_percent = self.conf.rollover_max_incremental_percent()
+        if max_percent is not None and chain.incremental_percent() >= max_percent:
+            return 'incrementals are %.1f%% of full' % chain.incremental_percent()
+        full_date = chain.full_date()
+        if full_date is None:
+            return None
+        max_age = self.conf.rollover_max_age_days()
+        if max_age is not None and (backup_date - full_date).days >= max_age:
+            return 'full is %d days old' % (backup_date - full_date).days
+        spread = self.conf.rollover_spread_days()
+        if spread is not None:
+            scheduled = self._last_scheduled_full(backup_date.date(), spread)
+            if full_date.date() < scheduled:
+                return 'full scheduled for %s' % scheduled
+        return None
+
+    def _last_scheduled_full(self, today, period):
+        """Return the latest date, on or before today, on which this profile
+        is scheduled a full backup.
+
+        Fulls fall every period days, offset by a hash of the archive
+        prefix so that different profiles' fulls are spread out rather than
+        all landing on the same day.
+        """
+        digest = hashlib.md5(self.conf.backup_archive_prefix()).hexdigest()
+        offset = int(digest, 16) % period
+        day = today.toordinal()
+        return datetime.date.fromordinal(day - (day - offset) % period)
+
+
+class SetChain(object):
+    """The chain of archives in a backup set leading to its latest
+    successful backup, newest first.
+    """
+    def __init__(self, set_root, archive_prefix):
+        self.set_root = set_root
+        self.archive_prefix = archive_prefix
+        self.archives = self._read_chain()
+
+    def _read_chain(self):
+        deps = backup_deps.BackupDeps(os.path.dirname(self.set_root), self.archive_prefix)
+        latest = self._latest_successful()
+        if latest is None:
+            return []
+        return [entry.archive for entry in deps.chain(latest)]
+
+    def _latest_successful(self):
+        try:
+            with open(os.path.join(self.set_root, 'latest_successful')) as lsf:
+                return lsf.readline().rstrip() or None
+        except IOError, exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+    def incremental_count(self):
+        return len(self.archives) - 1
+
+    def archive_bytes(self, archive):
+        """Total size of the slices of an archive in the set."""
+        return backup_deps.archive_bytes(self.set_root, archive)
+
+    def incremental_percent(self):
+        """Cumulative size of the incrementals as a percentage of the full.
+        """
+        full_bytes = self.archive_bytes(self.archives[-1])
+        if not full_bytes:
+            return 0.0
+        inc_bytes = sum(self.archive_bytes(archive) for archive in self.archives[:-1])
+        return 100.0 * inc_bytes / full_bytes
+
+    def full_date(self):
+        """When the full backup was taken, from its name, or None if the
+        name isn't in the usual form.
+        """
+        return backup_deps.archive_time(self.archives[-1], self.archive_prefix)
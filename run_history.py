@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+
+"""Keep a history of backup runs, for estimating future ones.
+"""
+
+import csv
+import datetime
+import errno
+import os.path
+
+HISTORY_FILENAME = 'run_history'
+
+FIELDS = ['started', 'finished', 'status', 'kind', 'archive',
+          'changed_bytes', 'archive_bytes']
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# How many of the most recent successful runs to base estimates on
+RECENT_RUNS = 10
+
+class RunRecord(object):
+    """One backup run.
+
+    started, finished: datetimes.
+    status: 'ok', 'failed' or 'unchanged'.
+    kind: 'full' or 'incremental'.
+    archive: the name of the archive made, or '' if none was.
+    changed_bytes: how many bytes of files had changed since the parent, as
+                   counted by what dar read.  For a full, that's all of them.
+    archive_bytes: the total size of the archive's slices.
+    """
+    def __init__(self, started, finished, status, kind='', archive='',
+                 changed_bytes=0, archive_bytes=0):
+        self.started = started
+        self.finished = finished
+        self.status = status
+        self.kind = kind
+        self.archive = archive
+        self.changed_bytes = int(changed_bytes)
+        self.archive_bytes = int(archive_bytes)
+
+    def seconds(self):
+        delta = self.finished - self.started
+        return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+    def as_row(self):
+        return [self.started.strftime(TIME_FORMAT),
+                self.finished.strftime(TIME_FORMAT),
+                self.status, self.kind, self.archive,
+                str(self.changed_bytes), str(self.archive_bytes)]
+
+    @classmethod
+    def from_row(cls, row):
+        values = dict(zip(FIELDS, row))
+        values['started'] = datetime.datetime.strptime(values['started'], TIME_FORMAT)
+        values['finished'] = datetime.datetime.strptime(values['finished'], TIME_FORMAT)
+        return cls(**values)
+
+
+class RunHistory(object):
+    """The run_history file in a backup root, one CSV row per run.
+    """
+    def __init__(self, backup_root):
+        self.filename = os.path.join(backup_root, HISTORY_FILENAME)
+
+    def records(self):
+        """Return every RunRecord, oldest first."""
+        try:
+            histf = open(self.filename, 'rb')
+        except IOError, exc:
+            if exc.errno == errno.ENOENT:
+                return []
+            raise
+        try:
+            return [RunRecord.from_row(row) for row in csv.reader(histf) if row]
+        finally:
+            histf.close()
+
+    def append(self, record):
+        with open(self.filename, 'ab') as histf:
+            csv.writer(histf).writerow(record.as_row())
+
+    def recent_successful(self, kind=None):
+        """Return the most recent successful runs that made an archive,
+        optionally only those of the given kind.
+        """
+        records = [record for record in self.records()
+                   if record.status == 'ok' and record.archive
+                   and (kind is None or record.kind == kind)]
+        return records[-RECENT_RUNS:]
+
+    def compression_ratio(self, kind=None):
+        """Archive bytes per changed byte over recent runs, or None if
+        there's no history to go on.
+        """
+        # Hard-link trees have no archive size to go on.
+        records = [record for record in self.recent_successful(kind)
+                   if record.changed_bytes and record.archive_bytes]
+        if not records:
+            return None
+        return (float(sum(record.archive_bytes for record in records))
+                / sum(record.changed_bytes for record in records))
+
+    def throughput(self, kind=None):
+        """Changed bytes backed up per second over recent runs, or None if
+        there's no history to go on.
+        """
+        records = [record for record in self.recent_successful(kind)
+                   if record.seconds() > 0]
+        if not records:
+            return None
+        return (float(sum(record.changed_bytes for record in records))
+                / sum(record.seconds() for record in records))
@@ -0,0 +1,260 @@
+#! /usr/bin/env python
+
+"""Upload backup sets to an S3-compatible object store.
+"""
+
+import errno
+import json
+import os
+import os.path
+import re
+from multiprocessing.pool import ThreadPool
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+MANIFEST_FILENAME = 's3_manifest'
+
+# Files in a backup set that change as backups are added, so are uploaded
+# again every time, after the slices they refer to.
+STATE_FILENAMES = ['backup_deps', 'latest_successful', 'write_counters',
+                   'work_units', 'checkpoint_journal']
+
+SLICE_PATTERN = re.compile(r'^.+\.\d+\.dar$')
+
+class S3Target(object):
+    """Mirror the backup sets under [backup] target to the bucket in [s3].
+
+    Slices are uploaded with multipart uploads, their parts sent in
+    parallel.  Each worker reads only the part it's sending, so no more
+    than concurrency parts are held in memory at once.
+
+    Progress is kept in an s3_manifest file in each backup set, saved as
+    each part completes.  Anything already uploaded is skipped next time,
+    and interrupted multipart uploads carry on from the parts they'd done.
+    """
+    def __init__(self, config, logger, noop=False):
+        """
+        config: The BackupConf object for the current instance.
+        logger: Where to log what's uploaded.
+        noop: If True, only log what would be uploaded.
+        """
+        self.conf = config
+        self.log = logger
+        self.noop = noop
+        self.bucket = config.s3_bucket()
+        self.prefix = config.s3_prefix()
+        self.part_size = config.s3_part_size_mb() * 1024 * 1024
+        self.concurrency = config.s3_concurrency()
+        self._client = None
+
+    def client(self):
+        """The boto3 S3 client, made on first use, which must not be in the
+        upload workers.
+        """
+        if self._client is None:
+            if boto3 is None:
+                raise RuntimeError('[s3] is enabled but boto3 is not installed')
+            self._client = boto3.client(
+                    's3',
+                    endpoint_url=self.conf.s3_endpoint_url(),
+                    region_name=self.conf.s3_region(),
+                    aws_access_key_id=self.conf.s3_access_key_id(),
+                    aws_secret_access_key=self.conf.s3_secret_access_key(),
+            )
+        return self._client
+
+    def key(self, *parts):
+        """The object key for a path relative to the backup root."""
+        return '/'.join([self.prefix.strip('/')] + list(parts)).lstrip('/')
+
+    def upload_all(self, backup_root):
+        """Upload every backup set under backup_root, then the files in
+        backup_root itself, such as current_set.
+        """
+        for set_name in sorted(os.listdir(backup_root)):
+            set_root = os.path.join(backup_root, set_name)
+            if os.path.isdir(set_root):
+                self.upload_set(set_root, set_name)
+        for filename in sorted(os.listdir(backup_root)):
+            path = os.path.join(backup_root, filename)
+            if os.path.isfile(path):
+                self._put_file(path, self.key(filename))
+
+    def upload_set(self, set_root, set_name):
+        """Upload the slices of a backup set that haven't been already,
+        then its state files.
+        """
+        manifest = UploadManifest(os.path.join(set_root, MANIFEST_FILENAME))
+        for filename in sorted(os.listdir(set_root)):
+            if not SLICE_PATTERN.match(filename):
+                continue
+            path = os.path.join(set_root, filename)
+            st = os.stat(path)
+            if manifest.is_done(filename, st.st_size, st.st_mtime):
+                continue
+            self._upload_slice(path, self.key(set_name, filename), manifest, filename)
+        for filename in STATE_FILENAMES:
+            path = os.path.join(set_root, filename)
+            if os.path.exists(path):
+                self._put_file(path, self.key(set_name, filename))
+
+    def _put_file(self, path, key):
+        """Upload a small file in one request."""
+        self.log.info('Upload %r to s3://%s/%s', path, self.bucket, key)
+        if self.noop:
+            return
+        with open(path, 'rb') as fobj:
+            self.client().put_object(Bucket=self.bucket, Key=key, Body=fobj.read())
+
+    def _upload_slice(self, path, key, manifest, filename):
+        """Upload a slice, with a multipart upload if it's bigger than a part.
+        """
+        st = os.stat(path)
+        size, mtime = st.st_size, st.st_mtime
+        if size <= self.part_size:
+            self._put_file(path, key)
+            if not self.noop:
+                manifest.set_done(filename, size, mtime)
+            return
+        self.log.info('Multipart upload %r to s3://%s/%s', path, self.bucket, key)
+        if self.noop:
+            return
+        upload = manifest.get_upload(filename, size, mtime)
+        if upload is not None:
+            self.log.info('Resuming upload %s with %d parts done',
+                          upload['upload_id'], len(upload['parts']))
+            try:
+                self._upload_parts(path, key, manifest, filename, upload)
+                return
+            except Exception, exc:
+                if not _is_no_such_upload(exc):
+                    raise
+                # Unfinished uploads are aborted by the store after a while.
+                self.log.warn('Upload %s of %r no longer exists, starting again',
+                              upload['upload_id'], path)
+        response = self.client().create_multipart_upload(Bucket=self.bucket, Key=key)
+        upload = manifest.start_upload(filename, size, mtime, response['UploadId'])
+        self._upload_parts(path, key, manifest, filename, upload)
+
+    def _upload_parts(self, path, key, manifest, filename, upload):
+        """Send the parts of a multipart upload that haven't been sent yet,
+        then complete it.
+        """
+        size = upload['size']
+        part_count = (size + self.part_size - 1) // self.part_size
+        todo = [number for number in range(1, part_count + 1)
+                if str(number) not in upload['parts']]
+        failures = []
+        # Made here, if it hasn't been already, as boto3 clients can't
+        # safely be made by several threads at once.
+        self.client()
+        pool = ThreadPool(self.concurrency)
+        try:
+            jobs = [(path, key, upload['upload_id'], number) for number in todo]
+            for number, etag, exc in pool.imap_unordered(self._upload_part, jobs):
+                if exc is None:
+                    manifest.set_part(filename, number, etag)
+                else:
+                    self.log.error('Part %d of %r failed: %s', number, path, exc)
+                    failures.append(exc)
+        finally:
+            pool.close()
+            pool.join()
+        if failures:
+            # The parts that did get through are in the manifest for next
+            # time, unless the upload itself has gone.
+            expired = [exc for exc in failures if _is_no_such_upload(exc)]
+            raise (expired or failures)[0]
+        parts = [{'PartNumber': int(number), 'ETag': etag}
+                 for (number, etag) in upload['parts'].items()]
+        parts.sort(key=lambda part: part['PartNumber'])
+        self.client().complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload['upload_id'],
+                MultipartUpload={'Parts': parts})
+        manifest.set_done(filename, size, upload['mtime'])
+
+    def _upload_part(self, job):
+        """Read and upload one part.  Runs in a worker thread.
+
+        Returns (part number, ETag, None), or (part number, None, exception)
+        if it failed, so the other parts can still be recorded.
+        """
+        path, key, upload_id, number = job
+        try:
+            with open(path, 'rb') as fobj:
+                fobj.seek((number - 1) * self.part_size)
+                body = fobj.read(self.part_size)
+            response = self.client().upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id,
+                    PartNumber=number, Body=body)
+        except Exception, exc:
+            return number, None, exc
+        return number, response['ETag'], None
+
+
+def _is_no_such_upload(exc):
+    """Return True if exc is the store saying a multipart upload doesn't
+    exist, because it's been completed, aborted or expired.
+    """
+    response = getattr(exc, 'response', None)
+    return isinstance(response, dict) and response.get('Error', {}).get('Code') == 'NoSuchUpload'
+
+
+class UploadManifest(object):
+    """The upload progress of the files in a backup set, saved as JSON.
+
+    For each filename it records the size and modification time of the
+    file uploaded, whether it's done and, for multipart uploads in
+    progress, the upload id and the ETag of each part sent.  A file
+    rewritten since, even at the same size, as most slices are, is
+    uploaded again.  It's rewritten after every change, so it's never more than
+    one part behind.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as manf:
+                self.files = json.load(manf)
+        except IOError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            self.files = {}
+
+    def save(self):
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as manf:
+            json.dump(self.files, manf, indent=1, sort_keys=True)
+        os.rename(temp_filename, self.filename)
+
+    def _matches(self, record, size, mtime):
+        return record['size'] == size and record.get('mtime') == mtime
+
+    def is_done(self, name, size, mtime):
+        record = self.files.get(name)
+        return bool(record and record['done'] and self._matches(record, size, mtime))
+
+    def get_upload(self, name, size, mtime):
+        """Return the record of an unfinished multipart upload of a file of
+        the given size and modification time, or None.
+        """
+        record = self.files.get(name)
+        if record and not record['done'] and self._matches(record, size, mtime) \
+                and record.get('upload_id'):
+            return record
+        return None
+
+    def start_upload(self, name, size, mtime, upload_id):
+        self.files[name] = {'size': size, 'mtime': mtime, 'done': False,
+                            'upload_id': upload_id, 'parts': {}}
+        self.save()
+        return self.files[name]
+
+    def set_part(self, name, number, etag):
+        self.files[name]['parts'][str(number)] = etag
+        self.save()
+
+    def set_done(self, name, size, mtime):
+        self.files[name] = {'size': size, 'mtime': mtime, 'done': True}
+        self.save()
@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+
+"""Run backup profiles on a schedule, as a long-running process.
+"""
+
+import backup_conf
+import locks
+import run_history
+import argparse
+import datetime
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# How often to look for profiles that are due, in seconds
+POLL_SECONDS = 60
+
+# The backup launcher, run once per backup as a child process
+BACKUP_LAUNCHER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backup')
+
+# Intervals are counted from this date, at [schedule] start_at, in UTC
+EPOCH = datetime.datetime(2000, 1, 1)
+
+class Scheduler(object):
+    """Start a backup of each profile when it's due, one child process
+    per backup, until sent SIGTERM or SIGINT.
+
+    A backup is started when:
+     - the profile isn't already being backed up by this scheduler.
+     - its scheduled time, plus jitter, has passed since its last run,
+       or retry_minutes has passed since that run failed.
+     - the host isn't too busy, or it has been held back max_delay_minutes.
+     - a slot for its target is free.
+
+    The child takes the profile's lock and the target slot itself, so
+    they're held for exactly as long as it runs, even if the scheduler
+    dies.  If a backup started by hand or by cron is running, or another
+    host took the last slot first, the child exits and it's tried again
+    later.  Each child is in a session of its own, so a Ctrl-C meant for
+    the scheduler doesn't interrupt the backups.
+
+    Times are all worked out in UTC, so the intervals between backups
+    don't change when the clocks go forward or back.
+    """
+    def __init__(self, options):
+        """
+        options: The options generated by argparse for 'backup'.
+        """
+        self.options = options
+        self.log = logging.getLogger(__name__)
+        self.profiles = [ScheduledProfile(specfile, options)
+                         for specfile in options.specfiles]
+        self._stopping = False
+
+    def run(self):
+        """Run until told to stop, then wait for any backups to finish."""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.log.warn('Scheduling %d profile(s)', len(self.profiles))
+        while True:
+            for profile in self.profiles:
+                profile.reap()
+            running = [profile for profile in self.profiles if profile.running()]
+            if self._stopping:
+                if not running:
+                    return
+                self.log.warn('Waiting for %d backup(s) to finish', len(running))
+            else:
+                now = datetime.datetime.utcnow()
+                for profile in self.profiles:
+                    if not profile.running():
+                        self._consider(profile, now)
+            time.sleep(POLL_SECONDS)
+
+    def _stop(self, signum, frame):
+        self.log.warn('Signal %d received, not starting any more backups', signum)
+        self._stopping = True
+
+    def _consider(self, profile, now):
+        """Start a backup of the profile if everything says it should."""
+        try:
+            profile.read_config()
+        except Exception, exc:
+            self.log.error('Can\'t read %s: %s', profile.specfile, exc)
+            return
+        due = profile.due_time()
+        if now < due:
+            return
+        delayed = now - due
+        busy = host_pressure_reason(profile.conf)
+        if busy is not None:
+            if delayed < datetime.timedelta(minutes=profile.conf.schedule_max_delay_minutes()):
+                profile.log_once('busy', logging.INFO,
+                                 '%s is due, but held back: %s', profile.specfile, busy)
+                return
+            self.log.warn('%s held back too long, starting anyway: %s', profile.specfile, busy)
+        slots = locks.TargetSlots(profile.conf.schedule_slots_dir(),
+                                  profile.conf.schedule_target_slots())
+        if not slots.any_free():
+            profile.log_once('slots', logging.INFO,
+                             '%s is due, but no slot is free in %s',
+                             profile.specfile, slots.directory)
+            return
+        profile.start()
+
+
+class ScheduledProfile(object):
+    """One backup profile, and the child process backing it up, if any.
+    """
+    def __init__(self, specfile, options):
+        self.specfile = os.path.abspath(specfile)
+        self.options = options
+        self.log = logging.getLogger(__name__)
+        self.conf = None
+        self._child = None
+        self._started = None
+        # The last run this scheduler has seen finish, as (started, finished,
+        # status), in UTC
+        self._last_run = None
+        self._logged = set()
+
+    def read_config(self):
+        """Read the profile again, so changes to it are picked up."""
+        self.conf = backup_conf.BackupConf(argparse.Namespace(specfile=self.specfile))
+
+    def running(self):
+        return self._child is not None
+
+    def start(self):
+        """Start backing up the profile, in a new session, taking a target
+        slot for as long as it runs.
+        """
+        cmd = [sys.executable, BACKUP_LAUNCHER, '-l', self.options.log_level, '--take-slot']
+        if self.options.noop:
+            cmd.append('--noop')
+        cmd.append(self.specfile)
+        self.log.warn('Starting %r', cmd)
+        self._started = datetime.datetime.utcnow()
+        self._logged.clear()
+        self._child = subprocess.Popen(cmd, close_fds=True, preexec_fn=os.setsid)
+
+    def reap(self):
+        """If the backup has finished, note how it went."""
+        if self._child is None or self._child.poll() is None:
+            return
+        returncode = self._child.returncode
+        if returncode == 0:
+            status = 'ok'
+        elif returncode == locks.EXIT_ALREADY_RUNNING:
+            status = 'busy'
+        else:
+            status = 'failed'
+        self.log.warn('%s finished: %s (exit status %d)', self.specfile, status, returncode)
+        self._last_run = (self._started, datetime.datetime.utcnow(), status)
+        self._child = None
+
+    def last_run(self):
+        """Return (started, finished, status) for the latest run, from the
+        run history or this scheduler's own, whichever is newer.  The times
+        are in UTC.
+
+        Runs with --noop aren't in the run history, so without the
+        scheduler's own record they'd be started over and over.
+        """
+        runs = [(_local_to_utc(record.started), _local_to_utc(record.finished), record.status)
+                for record in run_history.RunHistory(self.conf.backup_target()).records()]
+        if self._last_run is not None:
+            runs.append(self._last_run)
+        if not runs:
+            return None
+        return max(runs)
+
+    def due_time(self):
+        """When the next backup should start, in UTC.
+
+        That's the latest scheduled time if there's been no run since it,
+        retry_minutes after the last run if that didn't succeed, or else
+        the next scheduled time.
+        """
+        now = datetime.datetime.utcnow()
+        scheduled = self.last_scheduled_time(now)
+        last = self.last_run()
+        if last is None:
+            return scheduled
+        started, finished, status = last
+        if started < scheduled:
+            return scheduled
+        if status in ('failed', 'busy'):
+            return finished + datetime.timedelta(minutes=self.conf.schedule_retry_minutes())
+        return scheduled + self._interval()
+
+    def last_scheduled_time(self, now):
+        """The latest scheduled time, jitter included, on or before now,
+        both in UTC.
+
+        Scheduled times are every interval_hours from start_at, counted
+        from a fixed date so they don't drift from one run to the next.
+        """
+        hour, minute = self.conf.schedule_start_at()
+        anchor = EPOCH.replace(hour=hour, minute=minute) + self.jitter()
+        interval = _total_seconds(self._interval())
+        periods = int(_total_seconds(now - anchor) // interval)
+        return anchor + datetime.timedelta(seconds=periods * interval)
+
+    def jitter(self):
+        """The delay after each scheduled time for this host and profile."""
+        window = self.conf.schedule_jitter_minutes() * 60
+        if window <= 0:
+            return datetime.timedelta(0)
+        key = socket.gethostname() + ':' + self.conf.backup_archive_prefix()
+        digest = hashlib.md5(key).hexdigest()
+        return datetime.timedelta(seconds=int(digest, 16) % window)
+
+    def _interval(self):
+        return datetime.timedelta(hours=self.conf.schedule_interval_hours())
+
+    def log_once(self, key, level, msg, *args):
+        """Log a message about why a due backup hasn't started, once
+        until it does.
+        """
+        if key not in self._logged:
+            self._logged.add(key)
+            self.log.log(level, msg, *args)
+
+
+def host_pressure_reason(config):
+    """Return a string saying why the host is too busy to start a backup,
+    or None if it isn't.
+    """
+    max_load = config.schedule_max_load()
+    if max_load is None:
+        max_load = float(multiprocessing.cpu_count())
+    load = os.getloadavg()[0]
+    if load > max_load:
+        return 'load average %.2f > %.2f' % (load, max_load)
+    max_pressure = config.schedule_max_pressure()
+    for resource in ('cpu', 'io'):
+        pressure = read_pressure(resource)
+        if pressure is not None and pressure > max_pressure:
+            return '%s pressure %.1f%% > %.1f%%' % (resource, pressure, max_pressure)
+    return None
+
+def read_pressure(resource):
+    """Return the 'some avg10' percentage from /proc/pressure/<resource>,
+    or None if the kernel doesn't have pressure stall information.
+    """
+    try:
+        with open(os.path.join('/proc/pressure', resource)) as psif:
+            for line in psif:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    for field in fields[1:]:
+                        name, _, value = field.partition('=')
+                        if name == 'avg10':
+                            return float(value)
+    except (IOError, OSError):
+        return None
+    return None
+
+def _local_to_utc(moment):
+    """Convert a naive local datetime, as in the run history, to UTC."""
+    return datetime.datetime.utcfromtimestamp(time.mktime(moment.timetuple()))
+
+def _total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
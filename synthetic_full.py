@@ -0,0 +1,303 @@
+#! /usr/bin/env python
+
+"""Make a full backup out of the archives already taken, without going
+back to the source.
+"""
+
+import backup_conf
+import backup_deps
+import backup_operation
+import checkpoint
+import locks
+import program_runners
+import rollover_policy
+import datetime
+import errno
+import logging
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+from arglist import ArgList
+
+class SynthesisFailed(Exception):
+    pass
+
+class SyntheticFull(object):
+    """Merge the newest backup and its chain of parents into a new FULL
+    archive, and start a new backup set with it as the latest successful
+    backup, so the next backup taken from the source is an incremental.
+
+    The incrementals are merged with each other first, oldest first, then
+    the result merged with the full, so the full's data is only copied
+    once.  Compressed data is copied as it is, not recompressed.
+
+    Each volume's part of the backup, and each work unit of it if the
+    set's backups are made in units, is merged separately.
+
+    The new archive is named after the newest backup, as it holds the
+    source as of when that one was taken, so the next backup picks up
+    everything changed since then.  Files deleted since the full, which
+    the merges would otherwise keep, are left out of it.
+    """
+    def __init__(self, options):
+        """
+        options: The options generated by argparse.
+        """
+        self.options = options
+        self._setup_logging()
+        self._cmd = program_runners.LoggableCalls(self.log, self._noop())
+
+    def _setup_logging(self):
+        numeric_level = getattr(logging, self._log_level(), None)
+        if not isinstance(numeric_level, int):
+            raise ValueError('Invalid log level: %s' % self._log_level())
+        logging.basicConfig(level=numeric_level)
+        self.log = logging.getLogger(__name__)
+
+    def _log_level(self):
+        return self.options.log_level
+
+    def _noop(self):
+        return self.options.noop
+
+    def run(self):
+        """Run the merge."""
+        if self._noop():
+            self.log.warn('--noop set, won\'t do anything for real')
+        self.conf = backup_conf.BackupConf(self.options)
+        self.deps = backup_deps.BackupDeps(self._backup_root(),
+                                           self.conf.backup_archive_prefix())
+        lock = locks.ProfileLock(self._backup_root())
+        if not self._noop():
+            lock.acquire()
+        try:
+            self._synthesize()
+        finally:
+            lock.release()
+
+    def _backup_root(self):
+        """Where the backup sets are, as chosen by --root."""
+        return self.options.root or self.conf.backup_target()
+
+    def _synthesize(self):
+        chain = self._chain()
+        head = chain[-1]
+        if len(chain) == 1:
+            print('Newest backup %s is a full already, nothing to merge' % head.archive)
+            return
+        self.backup_date = backup_deps.archive_time(head.archive, self.conf.backup_archive_prefix())
+        if self.backup_date is None:
+            raise SynthesisFailed('Can\'t tell when %s was taken from its name' % head.archive)
+        rollover = rollover_policy.for_config(self.conf)
+        set_name = rollover.synthetic_set_name(self.backup_date)
+        set_root = self.deps.set_root(set_name)
+        if os.path.exists(os.path.join(set_root, 'latest_successful')):
+            raise SynthesisFailed('Backup set %s already has backups in it' % set_name)
+        archive = (self.conf.backup_archive_prefix()
+                   + self.backup_date.strftime('%Y-%m-%dT%H%M')
+                   + '-FULL')
+        print('Merging %d archives up to %s into: %s/%s' % (
+                len(chain), head.archive, set_name, archive))
+        self._make_dir(set_root)
+        work_dir = self._make_work_dir(set_root)
+        units = checkpoint.WorkUnits.load(self.deps.set_root(head.set_name))
+        try:
+            for part in self._part_names():
+                if units is None:
+                    part_units = [None]
+                else:
+                    part_units = units.unit_names(checkpoint.part_key(part))
+                for unit in part_units:
+                    self._merge_part(chain, part, unit, os.path.join(set_root, archive), work_dir)
+        finally:
+            if not self._noop():
+                shutil.rmtree(work_dir)
+        self._record(set_root, archive, head, units)
+        if not self._noop():
+            rollover.remember_set(self._backup_root(), set_name)
+
+    def _chain(self):
+        """Return the DepsEntry for each archive to merge, oldest (the full)
+        first.
+        """
+        newest = self.deps.newest()
+        if newest is None:
+            raise SynthesisFailed('No backups found in %s' % self._backup_root())
+        chain = [entry for entry in self.deps.chain(newest.archive) if entry.has_archive()]
+        if any(entry.is_tree() for entry in chain):
+            raise SynthesisFailed('Hard-link tree backups can\'t be merged')
+        chain.reverse()
+        return chain
+
+    def _part_names(self):
+        """The name of each part a backup is made up of: None for the main
+        volume, then any other volumes'.
+        """
+        if self.conf.source_is_lvm():
+            return [volume.name for volume in self.conf.lvm_volumes()]
+        return [None]
+
+    def _merge_part(self, chain, part, unit, archive_path, work_dir):
+        """Merge one part, or one work unit of it, of each archive in the
+        chain into the same part or unit of the new archive.
+        """
+        bases = []
+        for entry in chain:
+            name = self._unit_name(entry.archive, part, unit)
+            base = os.path.join(self.deps.set_root(entry.set_name), name)
+            if os.path.exists(base + '.1.dar'):
+                bases.append(base)
+            else:
+                self.log.info('No %s in %s', os.path.basename(base), entry.archive)
+        output = self._unit_name(archive_path, part, unit)
+        if not bases:
+            self.log.warn('No archives to merge into %s', output)
+            return
+        full, incrementals = bases[0], bases[1:]
+        removed = self._write_removed_list(self._removed_paths(bases),
+                                           os.path.join(work_dir, os.path.basename(output) + '.removed'))
+        merged_inc = None
+        for number, incremental in enumerate(incrementals):
+            if merged_inc is None:
+                merged_inc = incremental
+                continue
+            merged = os.path.join(work_dir, '%s.inc%d' % (os.path.basename(output), number))
+            self._merge(merged, merged_inc, incremental)
+            if merged_inc.startswith(work_dir):
+                self._remove_archive(merged_inc)
+            merged_inc = merged
+        self._merge(output, full, merged_inc, removed)
+
+    def _unit_name(self, archive, part, unit):
+        """The name of a part, or of a work unit of a part, of an archive."""
+        name = backup_deps.part_name(archive, part)
+        if unit is not None:
+            name = backup_deps.part_name(name, unit)
+        return name
+
+    def _removed_paths(self, bases):
+        """Return the paths in any of the archives that aren't in the newest
+        one, or are recorded in it as deleted, leaving out those under
+        others already returned.
+
+        An incremental's catalogue lists everything in the source when it
+        was taken, saved or not, so anything it doesn't list has been
+        deleted since the older archives were made.
+        """
+        seen = set()
+        for base in bases[:-1]:
+            seen.update(name for (name, flags) in self._list_archive(base))
+        head = self._list_archive(bases[-1])
+        seen.update(name for (name, flags) in head)
+        live = set(name for (name, flags) in head if 'REMOVED' not in flags)
+        removed = []
+        for name in sorted(seen - live):
+            if removed and name.startswith(removed[-1] + '/'):
+                continue
+            removed.append(name)
+        if removed:
+            self.log.info('%d paths deleted since %s', len(removed), os.path.basename(bases[0]))
+        return removed
+
+    def _write_removed_list(self, paths, filename):
+        """Write the paths to leave out of the merge to a file for dar's -]
+        option, one per line, and return its name, or None if there are
+        none.  dar takes them literally, so they aren't escaped.
+
+        A file rather than a -P each, as there can be too many paths for
+        one command line.
+        """
+        if not paths:
+            return None
+        if not self._noop():
+            with open(filename, 'w') as listf:
+                for path in paths:
+                    if '\n' in path:
+                        self.log.warn('Can\'t leave out %r, which has a newline in its name', path)
+                        continue
+                    listf.write(path + '\n')
+        return filename
+
+    def _list_archive(self, base):
+        """Return (path, flags) for every entry in an archive's catalogue."""
+        list_cmd = ArgList(['dar', '-Q'])
+        list_cmd.append('-l', base)
+        list_cmd.append('-Tslice')
+        self._cmd.log_cmd(list_cmd)
+        listing = []
+        for line in subprocess.check_output(list_cmd).splitlines():
+            fields = line.split('|')
+            # Skip the heading, and the lines around it
+            if len(fields) < 3 or fields[2].strip() == 'Permission':
+                continue
+            listing.append((fields[-1].strip(), fields[1]))
+        return listing
+
+    def _merge(self, output, in_place, to_be_added=None, removed=None):
+        """Run dar to merge two archives, or copy one if to_be_added is None,
+        leaving out the paths listed in the file removed, if given.
+        """
+        merge_cmd = ArgList(['dar', '-Q'])
+        merge_cmd.append('-+', output)
+        merge_cmd.append('-A', in_place)
+        if to_be_added is not None:
+            merge_cmd.append('-@', to_be_added)
+            merge_cmd.append('-/', self.conf.synthesize_overwrite_policy())
+        # Copy compressed data as it is
+        merge_cmd.append('-ak')
+        merge_cmd.append('-w')
+        merge_cmd.append('-s', str(backup_operation.SLICE_SIZE))
+        if removed is not None:
+            merge_cmd.append('-]', removed)
+        self._cmd.check_call(merge_cmd)
+
+    def _remove_archive(self, base):
+        """Remove the slices of an intermediate archive."""
+        pattern = re.compile(r'^%s\.\d+\.dar$' % re.escape(os.path.basename(base)))
+        directory = os.path.dirname(base)
+        if self._noop():
+            return
+        for filename in os.listdir(directory):
+            if pattern.match(filename):
+                os.remove(os.path.join(directory, filename))
+
+    def _make_dir(self, path):
+        if self._noop():
+            return
+        try:
+            os.mkdir(path)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def _make_work_dir(self, set_root):
+        """Make a directory for the intermediate archives, next to where
+        the new one goes.
+        """
+        if self._noop():
+            return os.path.join(set_root, '.synthesize')
+        return tempfile.mkdtemp(prefix='.synthesize-', dir=set_root)
+
+    def _record(self, set_root, archive, head, units):
+        """Record the new archive as the full, and latest successful backup,
+        of the new set.
+
+        The write counters of the head of the chain are copied over, as
+        they describe the source as of the new archive too.  So are the
+        work units, if any, as the new set's incrementals need the same.
+        """
+        self.log.debug('Recording %r as the latest successful backup in %r', archive, set_root)
+        if self._noop():
+            return
+        with open(os.path.join(set_root, 'latest_successful'), 'w') as lsf:
+            lsf.write(archive + '\n')
+        with open(os.path.join(set_root, backup_deps.DEPS_FILENAME), 'a') as depf:
+            depf.write('%s:\n' % archive)
+        counters = os.path.join(self.deps.set_root(head.set_name), 'write_counters')
+        if os.path.exists(counters):
+            shutil.copy(counters, os.path.join(set_root, 'write_counters'))
+        if units is not None:
+            units.save(set_root)
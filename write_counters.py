@@ -0,0 +1,167 @@
+#! /usr/bin/env python
+
+"""Read the kernel's write counters for a block device.
+"""
+
+import os
+import os.path
+import errno
+import ctypes
+import ctypes.util
+import subprocess
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _syncfs = _libc.syncfs
+    _syncfs.argtypes = [ctypes.c_int]
+    _syncfs.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _syncfs = None
+
+class WriteCounters(object):
+    """The write counters for one or more block devices, at the time they
+    were read.
+
+    Two counters are used, when available:
+     lifetime_write_kbytes - from /sys/fs/ext4/<dev>/, only present while an
+                             ext4 filesystem on the device is mounted.
+                             Kept in the superblock, so survives reboots.
+     sectors_written - from /sys/block/<dev>/stat.  Reset at boot, so it's
+                       only comparable alongside the boot_id it was read in.
+    """
+    def __init__(self, values=None):
+        """
+        values: A dict of counter names to string values, as returned by
+                as_dict().  Usually you'd use for_device() or load() instead.
+        """
+        self.values = dict(values or {})
+
+    @classmethod
+    def for_device(cls, device):
+        """Read the current counters for the given device path,
+        for example /dev/data/os-xub-precise.
+        """
+        kernel_name = os.path.basename(os.path.realpath(device))
+        values = {}
+        values['boot_id'] = _read_first_line('/proc/sys/kernel/random/boot_id')
+        stat = _read_first_line(os.path.join('/sys/block', kernel_name, 'stat'))
+        if stat is not None:
+            # The 7th field is the number of sectors written.
+            values['sectors_written'] = stat.split()[6]
+        values['lifetime_write_kbytes'] = _read_first_line(
+                os.path.join('/sys/fs/ext4', kernel_name, 'lifetime_write_kbytes'))
+        return cls(dict((k, v) for (k, v) in values.items() if v is not None))
+
+    @classmethod
+    def for_volumes(cls, devices):
+        """Read the current counters for several devices at once.
+
+        devices: A list of (name, device path) pairs.  The counters of all
+                 but the one named None get 'name.' put before their keys.
+        """
+        values = {}
+        for name, device in devices:
+            for key, value in cls.for_device(device).values.items():
+                if name is not None:
+                    key = '%s.%s' % (name, key)
+                values[key] = value
+        return cls(values)
+
+    @classmethod
+    def load(cls, filename):
+        """Read counters saved with save(), or None if the file doesn't exist.
+        """
+        try:
+            countf = open(filename)
+        except IOError, exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+        values = {}
+        try:
+            for line in countf:
+                key, _, value = line.rstrip('\n').partition('=')
+                if key:
+                    values[key] = value
+        finally:
+            countf.close()
+        return cls(values)
+
+    def save(self, filename):
+        """Write the counters to the given file."""
+        with open(filename, 'w') as countf:
+            for key in sorted(self.values):
+                countf.write('%s=%s\n' % (key, self.values[key]))
+
+    def as_dict(self):
+        return dict(self.values)
+
+    def unchanged_since(self, previous):
+        """Return True if nothing has been written to the device(s) since
+        the previous counters were read.
+
+        If they weren't read for the same devices, or for any device there's
+        no counter both can be compared on, assume it has changed.
+        """
+        if previous is None:
+            return False
+        mine, theirs = self._by_volume(), previous._by_volume()
+        if sorted(mine) != sorted(theirs):
+            return False
+        for name in mine:
+            if not _device_unchanged(mine[name], theirs[name]):
+                return False
+        return True
+
+    def _by_volume(self):
+        """Split the values up by the volume name put before them by
+        for_volumes(), with '' for the main volume.
+        """
+        volumes = {}
+        for key, value in self.values.items():
+            name, _, counter = key.rpartition('.')
+            volumes.setdefault(name, {})[counter] = value
+        return volumes
+
+    def __repr__(self):
+        return 'WriteCounters(%r)' % self.values
+
+
+def sync_filesystem(path):
+    """Write the filesystem holding path's dirty pages out to disk, so the
+    write counters include them.
+
+    Uses syncfs(2) where it's available, so only that filesystem is
+    flushed, and sync(1) otherwise.
+    """
+    if _syncfs is not None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if _syncfs(fd) == 0:
+                return
+        finally:
+            os.close(fd)
+    subprocess.check_call(['sync'])
+
+
+def _device_unchanged(mine, theirs):
+    """Compare the counters of one device, as described in unchanged_since().
+    """
+    if 'lifetime_write_kbytes' in mine and 'lifetime_write_kbytes' in theirs:
+        return mine['lifetime_write_kbytes'] == theirs['lifetime_write_kbytes']
+    if 'sectors_written' in mine and 'sectors_written' in theirs \
+            and mine.get('boot_id') == theirs.get('boot_id'):
+        return mine['sectors_written'] == theirs['sectors_written']
+    return False
+
+
+def _read_first_line(filename):
+    """Return the first line of the file, stripped, or None if it doesn't exist.
+    """
+    try:
+        with open(filename) as fobj:
+            return fobj.readline().strip()
+    except IOError, exc:
+        if exc.errno == errno.ENOENT:
+            return None
+        raise